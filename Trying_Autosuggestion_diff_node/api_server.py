@@ -1,7 +1,18 @@
+import json
+import logging
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import uvicorn
-from src.graph import start_joke_generation, continue_with_explanation, get_thread_status, handle_user_action
+from src.config import setup_logging, close_llm
+
+# Configure logging before the workflow is built so its setup messages are kept
+setup_logging()
+
+from src.graph import start_joke_generation, stream_joke_generation, continue_with_explanation, get_thread_status, handle_user_action, open_checkpointer, close_checkpointer
+from src.core import start_joke_batcher, stop_joke_batcher
+
+logger = logging.getLogger(__name__)
 
 # Create stateful FastAPI app
 app = FastAPI(
@@ -10,6 +21,18 @@ app = FastAPI(
     description="API with persistent state management, interrupts, and smart autosuggestions"
 )
 
+@app.on_event("startup")
+async def startup_event():
+    await open_checkpointer()
+    # Coalesce concurrent /start requests into batched LLM calls
+    start_joke_batcher()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await stop_joke_batcher()
+    await close_checkpointer()
+    await close_llm()
+
 # Request models
 class StartRequest(BaseModel):
     topic: str
@@ -26,13 +49,14 @@ class ActionRequest(BaseModel):
     action: str  # The autosuggestion action ID selected by user
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {
         "message": "Stateful Joke Generation API with Autosuggestions is running!",
         "version": "3.0.0",
         "endpoints": [
             "/health",
             "/start - Start joke generation",
+            "/start/stream - Start joke generation, streaming the joke as Server-Sent Events",
             "/continue - Generate explanation and autosuggestions",
             "/action - Handle user's selected autosuggestion",
             "/status - Check thread status"
@@ -40,14 +64,14 @@ def read_root():
     }
 
 @app.get("/health")
-def health_check():
-    return {"status": "healthy", "persistence": "InMemory", "features": ["interrupts", "autosuggestions"]}
+async def health_check():
+    return {"status": "healthy", "persistence": "SQLite", "features": ["interrupts", "autosuggestions"]}
 
 @app.post("/start")
-def start_endpoint(request: StartRequest):
+async def start_endpoint(request: StartRequest):
     try:
-        print(f"API /start - topic: {request.topic}, thread: {request.thread_id}")
-        result = start_joke_generation(request.topic, request.thread_id)
+        logger.info("API /start - topic: %s, thread: %s", request.topic, request.thread_id)
+        result = await start_joke_generation(request.topic, request.thread_id)
         
         return {
             "success": True,
@@ -58,14 +82,46 @@ def start_endpoint(request: StartRequest):
             "message": "Joke generated. Call /continue to get explanation."
         }
     except Exception as e:
-        print(f"API error in /start: {str(e)}")
+        logger.error("API error in /start: %s", e)
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+@app.post("/start/stream")
+async def start_stream_endpoint(request: StartRequest):
+    """
+    Same as /start, but streams the joke as Server-Sent Events while it is generated.
+    Each event's data is JSON: {"token": ...} per chunk, then a final "done" event
+    with the full joke (or an "error" event). Call /continue afterwards as usual.
+    """
+    logger.info("API /start/stream - topic: %s, thread: %s", request.topic, request.thread_id)
+    
+    async def event_stream():
+        parts = []
+        try:
+            async for text in stream_joke_generation(request.topic, request.thread_id):
+                parts.append(text)
+                yield f"data: {json.dumps({'token': text})}\n\n"
+        except Exception as e:
+            logger.error("API error in /start/stream: %s", e)
+            yield f"event: error\ndata: {json.dumps({'detail': f'Error: {str(e)}'})}\n\n"
+            return
+        
+        done = {
+            "success": True,
+            "thread_id": request.thread_id,
+            "topic": request.topic,
+            "joke": "".join(parts).strip(),
+            "status": "joke_generated",
+            "message": "Joke generated. Call /continue to get explanation."
+        }
+        yield f"event: done\ndata: {json.dumps(done)}\n\n"
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.post("/continue")
-def continue_endpoint(request: ContinueRequest):
+async def continue_endpoint(request: ContinueRequest):
     try:
-        print(f"API /continue - thread: {request.thread_id}")
-        result = continue_with_explanation(request.thread_id)
+        logger.info("API /continue - thread: %s", request.thread_id)
+        result = await continue_with_explanation(request.thread_id)
         
         return {
             "success": True,
@@ -78,15 +134,24 @@ def continue_endpoint(request: ContinueRequest):
             "message": "Explanation and autosuggestions generated. Use /action to select an autosuggestion."
         }
     except ValueError as e:
-        print(f"API validation error in /continue (Invalid thread id): {str(e)}")
+        logger.warning("API validation error in /continue (Invalid thread id): %s", e)
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
-        print(f"API error in /continue: {str(e)}")
+        logger.error("API error in /continue: %s", e)
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 
+# Response message for each /action result status
+_ACTION_MESSAGES = {
+    "joke_regenerated": "New joke generated! Call /continue to get explanation and new suggestions.",
+    "joke_enhanced": "New joke generated! Call /continue to get explanation and new suggestions.",
+    "similar_joke_generated": "New joke generated! Call /continue to get explanation and new suggestions.",
+    "explanation_simplified": "Explanation simplified! New autosuggestions available.",
+    "new_topic_requested": "Session completed. Call /start with a new topic."
+}
+
 @app.post("/action")
-def action_endpoint(request: ActionRequest):
+async def action_endpoint(request: ActionRequest):
     """
     Handle user's selected autosuggestion action.
     
@@ -98,8 +163,8 @@ def action_endpoint(request: ActionRequest):
     - new_topic: Request a new topic (returns completed status)
     """
     try:
-        print(f"API /action - thread: {request.thread_id}, action: {request.action}")
-        result = handle_user_action(request.thread_id, request.action)
+        logger.info("API /action - thread: %s, action: %s", request.thread_id, request.action)
+        result = await handle_user_action(request.thread_id, request.action)
         
         response = {
             "success": True,
@@ -113,29 +178,22 @@ def action_endpoint(request: ActionRequest):
         }
         
         # Add appropriate message based on status
-        if result['status'] in ['joke_regenerated', 'joke_enhanced', 'similar_joke_generated']:
-            response["message"] = "New joke generated! Call /continue to get explanation and new suggestions."
-        elif result['status'] == 'explanation_simplified':
-            response["message"] = "Explanation simplified! New autosuggestions available."
-        elif result['status'] == 'new_topic_requested':
-            response["message"] = "Session completed. Call /start with a new topic."
-        else:
-            response["message"] = "Action completed."
+        response["message"] = _ACTION_MESSAGES.get(result['status'], "Action completed.")
         
         return response
         
     except ValueError as e:
-        print(f"API validation error in /action: {str(e)}")
+        logger.warning("API validation error in /action: %s", e)
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
-        print(f"API error in /action: {str(e)}")
+        logger.error("API error in /action: %s", e)
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 @app.post("/status")
-def status_endpoint(request: StatusRequest):
+async def status_endpoint(request: StatusRequest):
     try:
-        print(f"API /status - thread: {request.thread_id}")
-        result = get_thread_status(request.thread_id)
+        logger.info("API /status - thread: %s", request.thread_id)
+        result = await get_thread_status(request.thread_id)
         
         if not result.get('exists'):
             raise HTTPException(status_code=404, detail=result.get('message'))
@@ -147,7 +205,7 @@ def status_endpoint(request: StatusRequest):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"API error in /status: {str(e)}")
+        logger.error("API error in /status: %s", e)
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 # if __name__ == "__main__":
@@ -3,8 +3,13 @@ Main application entry point for the stateful joke generation agent.
 Runs the FastAPI server.
 """
 
+import os
+import sys
 import uvicorn
-from api_server import app
+
+# Same variable uvicorn reads when started directly (as in the Dockerfile). Each worker
+# has its own joke batcher, caches and prefetches; all share the SQLite checkpointer
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
 
 
 def main():
@@ -18,11 +23,18 @@ def main():
     print("  - POST /continue - Generate explanation")
     print("  - POST /status - Check thread status")
     print("=" * 60)
-    print("Server running on http://0.0.0.0:8000")
+    print(f"Server running on http://0.0.0.0:8000 with {WORKERS} workers")
     print("Press CTRL+C to stop")
     print("=" * 60)
     
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "api_server:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=WORKERS,
+        loop="uvloop" if sys.platform != "win32" else "asyncio",  # uvloop has no Windows support
+        http="httptools"
+    )
 
 
 if __name__ == "__main__":
@@ -1,6 +1,12 @@
 """Simple configuration for the joke agent."""
 
+import atexit
+import logging
 import os
+import queue
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+import httpx
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI
 
@@ -9,14 +15,104 @@ load_dotenv()
 
 # Simple configuration
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-MODEL_NAME = os.getenv("MODEL_NAME", "gemma-3-27b-it")
+# Must support JSON-schema responses (Gemma models don't), since every call uses structured output
+MODEL_NAME = os.getenv("MODEL_NAME", "gemini-2.5-flash")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
+# Workflow persistence: SQLite file shared by all server workers, and how long
+# an inactive thread is kept before the cleanup job deletes it
+CHECKPOINT_DB = os.getenv("CHECKPOINT_DB", "checkpoints.db")
+CHECKPOINT_TTL_HOURS = float(os.getenv("CHECKPOINT_TTL_HOURS", "24"))
+
+# Request coalescing for /start: up to JOKE_BATCH_SIZE topics arriving within
+# JOKE_BATCH_WINDOW_MS of each other are sent to the LLM as one prompt
+JOKE_BATCH_SIZE = int(os.getenv("JOKE_BATCH_SIZE", "8"))
+JOKE_BATCH_WINDOW_MS = float(os.getenv("JOKE_BATCH_WINDOW_MS", "20"))
+
+# Response cache: once JOKE_CACHE_POOL_SIZE jokes have been generated for a topic,
+# /start picks one of them at random until they expire after JOKE_CACHE_TTL_SECONDS
+JOKE_CACHE_POOL_SIZE = int(os.getenv("JOKE_CACHE_POOL_SIZE", "3"))
+JOKE_CACHE_TTL_SECONDS = float(os.getenv("JOKE_CACHE_TTL_SECONDS", "3600"))
+
+def setup_logging():
+    """
+    Configure root logging at LOG_LEVEL through a QueueHandler, with a QueueListener
+    thread doing the actual stdout writes so request handlers never block on I/O.
+    Does nothing if the root logger is already configured.
+    """
+    if logging.getLogger().handlers:
+        return
+    
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = QueueListener(log_queue, stream_handler)
+    
+    # The queue handler only merges args into the message; the stream handler does the formatting
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    
+    logging.basicConfig(level=LOG_LEVEL, handlers=[queue_handler])
+    listener.start()
+    atexit.register(listener.stop)
+
+
+# HTTP settings for the LLM client's connection pool: one keep-alive, HTTP/2
+# multiplexed pool shared by all requests in the process
+LLM_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=100, max_connections=200)
+
+
+class LLMHTTPTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """
+    HTTP/2 pooled httpx transport for the LLM client, usable by both its sync and async
+    httpx clients (langchain-google-genai passes the same client args to both). Passing
+    an explicit transport also stops google-genai from sending async calls through
+    aiohttp, which it otherwise prefers whenever aiohttp is installed.
+    """
+    
+    def __init__(self):
+        self._sync = httpx.HTTPTransport(http2=True, limits=LLM_HTTP_LIMITS)
+        self._async = httpx.AsyncHTTPTransport(http2=True, limits=LLM_HTTP_LIMITS)
+    
+    def handle_request(self, request):
+        return self._sync.handle_request(request)
+    
+    async def handle_async_request(self, request):
+        return await self._async.handle_async_request(request)
+    
+    def close(self):
+        self._sync.close()
+    
+    async def aclose(self):
+        await self._async.aclose()
+
+
+@lru_cache(maxsize=1)
 def get_llm():
-    """Get the language model."""
+    """Get the language model (built once per process and reused)."""
     if not GOOGLE_API_KEY:
         raise ValueError("GOOGLE_API_KEY environment variable is required")
     
     return ChatGoogleGenerativeAI(
         model=MODEL_NAME,
-        google_api_key=GOOGLE_API_KEY
+        google_api_key=GOOGLE_API_KEY,
+        client_args={"transport": LLMHTTPTransport()}
     )
+
+
+async def close_llm():
+    """Close the LLM client's connection pool; call on server shutdown."""
+    if get_llm.cache_info().currsize:
+        await get_llm().aclose()
+        get_structured_llm.cache_clear()
+        get_llm.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def get_structured_llm(model_cls):
+    """
+    Get the language model bound to a Pydantic output schema (one instance per schema).
+    The schema is enforced by the provider's native JSON schema mode, so prompts don't
+    need format instructions.
+    """
+    return get_llm().with_structured_output(model_cls, method="json_schema")
@@ -1,8 +1,13 @@
-from .config import get_llm
+import asyncio
+import logging
+import random
+from cachetools import TTLCache
+from .config import get_llm, get_structured_llm, JOKE_BATCH_SIZE, JOKE_BATCH_WINDOW_MS, JOKE_CACHE_POOL_SIZE, JOKE_CACHE_TTL_SECONDS
 from pydantic import BaseModel, Field
-from langchain_core.output_parsers import PydanticOutputParser
 from typing import List
 
+logger = logging.getLogger(__name__)
+
 
 # Pydantic models for structured outputs
 class JokeOutput(BaseModel):
@@ -15,61 +20,242 @@ class ExplanationOutput(BaseModel):
     explanation: str = Field(description="An explanation of why the joke is funny")
 
 
-class AutosuggestionSelection(BaseModel):
-    """Model for autosuggestion selection output"""
-    selected_action_ids: List[str] = Field(
-        description="List of 3-4 selected action IDs in order of relevance",
-        min_items=3,
-        max_items=4
-    )
+class JokePipelineOutput(BaseModel):
+    """Model for the combined joke and explanation output"""
+    joke: str = Field(description="A funny joke about the given topic")
+    explanation: str = Field(description="An explanation of why the joke is funny")
 
 
-def generate_joke(state):
-    try:
-        llm = get_llm()
-        topic = state.get("topic", "general")
+class JokePipelineBatchOutput(BaseModel):
+    """Model for a batch of combined outputs, one per requested topic"""
+    items: List[JokePipelineOutput] = Field(description="One entry per topic, in the same order as the topics")
+
+
+# Actions the user can pick from after a joke has been explained
+AVAILABLE_ACTIONS = [
+    {
+        "id": "another_joke",
+        "label": "Tell me another joke about this topic",
+        "description": "Generate a completely new joke about the same topic"
+    },
+    {
+        "id": "simpler_explanation",
+        "label": "Explain this in simpler words",
+        "description": "Rephrase the explanation to be easier to understand"
+    },
+    {
+        "id": "new_topic",
+        "label": "Tell me a joke about a different topic",
+        "description": "Start fresh with a new topic"
+    },
+    {
+        "id": "make_funnier",
+        "label": "Make it funnier",
+        "description": "Enhance the joke to make it more humorous"
+    },
+    {
+        "id": "similar_joke",
+        "label": "Tell me a similar joke",
+        "description": "Generate a joke with similar style or theme"
+    }
+]
+
+ACTIONS_BY_ID = {action["id"]: action for action in AVAILABLE_ACTIONS}
+
+# Jokes shorter than this are simple enough that "explain in simpler words" isn't suggested
+SHORT_JOKE_LENGTH = 80
+
+# Prompt templates with all static text resolved at import;
+# only the per-request fields are filled in with format_map
+_PIPELINE_PROMPT = (
+    "Generate a funny joke about {topic}.\n\n"
+    "Then explain why the joke is funny in a clear and engaging way."
+)
+_PIPELINE_BATCH_PROMPT = (
+    "For each of the following topics, generate a funny joke about it and explain why the joke is funny.\n\n"
+    "Topics:\n{topics}\n\n"
+    "Return exactly one item per topic, in the same order as the topics."
+)
+_JOKE_PROMPT = "Generate a funny joke about {topic}. Reply with the joke only."
+_EXPLANATION_PROMPT = "Explain why this joke is funny: {joke}"
+_ANOTHER_JOKE_PROMPT = "Generate a different funny joke about {topic}. Make it unique and different from this one: {joke}"
+_SIMPLER_EXPLANATION_PROMPT = "Rephrase this explanation in very simple, easy-to-understand words suitable for a child: {explanation}"
+_FUNNIER_JOKE_PROMPT = "Make this joke funnier and more entertaining while keeping the same topic ({topic}): {joke}"
+_SIMILAR_JOKE_PROMPT = "Generate a joke similar in style and humor to this one, but with different content: {joke}"
+
+
+# Generated results reused across threads: normalized topic -> list of generate_joke
+# results, and joke -> explanation
+_JOKE_CACHE = TTLCache(maxsize=1024, ttl=JOKE_CACHE_TTL_SECONDS)
+_EXPLANATION_CACHE = TTLCache(maxsize=1024, ttl=JOKE_CACHE_TTL_SECONDS)
+
+
+def _suggest_actions(joke):
+    """Pick the first 4 available actions, leaving out simpler_explanation for short jokes."""
+    actions = AVAILABLE_ACTIONS
+    if len(joke or "") < SHORT_JOKE_LENGTH:
+        actions = [action for action in actions if action["id"] != "simpler_explanation"]
+    return actions[:4]
+
+
+async def _generate_pipeline(topic):
+    """Run the combined joke/explanation prompt for a single topic."""
+    prompt = _PIPELINE_PROMPT.format_map({"topic": topic})
+    return await get_structured_llm(JokePipelineOutput).ainvoke(prompt)
+
+
+async def _generate_pipeline_batch(topics):
+    """Run the combined prompt for several topics in one LLM call, one output per topic."""
+    if len(topics) == 1:
+        return [await _generate_pipeline(topics[0])]
+    
+    topics_str = "\n".join([f"{i}. {topic}" for i, topic in enumerate(topics, start=1)])
+    prompt = _PIPELINE_BATCH_PROMPT.format_map({"topics": topics_str})
+    
+    items = (await get_structured_llm(JokePipelineBatchOutput).ainvoke(prompt)).items
+    if len(items) != len(topics):
+        raise ValueError(f"Expected {len(topics)} batch items, got {len(items)}")
+    return items
+
+
+async def stream_joke(topic):
+    """Yield the text of a new joke about topic as the LLM produces it."""
+    prompt = _JOKE_PROMPT.format_map({"topic": topic})
+    async for chunk in get_llm().astream(prompt):
+        if chunk.content:
+            yield chunk.content
+
+
+async def joke_batcher_loop(queue):
+    """
+    Coalesce concurrent joke requests from the queue into batched LLM calls.
+    Each queue item is a (topic, future) pair; the future receives that topic's output.
+    """
+    loop = asyncio.get_running_loop()
+    window = JOKE_BATCH_WINDOW_MS / 1000
+    
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + window
         
-        # Set up output parser
-        parser = PydanticOutputParser(pydantic_object=JokeOutput)
+        # Collect whatever else arrives within the batching window
+        while len(batch) < JOKE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
         
-        prompt = f"""Generate a funny joke about {topic}.
-
-{parser.get_format_instructions()}"""
+        topics = [topic for topic, _ in batch]
+        logger.info("Generating jokes for batch of %s topics: %s", len(topics), topics)
         
-        print(f"Generating joke for topic: {topic}")
-        response = llm.invoke(prompt)
-        parsed_output = parser.parse(response.content)
-        print("Joke generated successfully")
+        try:
+            results = await _generate_pipeline_batch(topics)
+        except Exception as e:
+            # Fall back to one call per topic so a single bad item doesn't fail the whole batch
+            logger.warning("Batched joke generation failed (%s), retrying per topic", e)
+            results = await asyncio.gather(*[_generate_pipeline(topic) for topic in topics], return_exceptions=True)
         
-        return {
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+_joke_queue = None
+_joke_batcher_task = None
+
+
+def start_joke_batcher():
+    """Start the background joke batcher on the running event loop."""
+    global _joke_queue, _joke_batcher_task
+    _joke_queue = asyncio.Queue()
+    _joke_batcher_task = asyncio.create_task(joke_batcher_loop(_joke_queue))
+
+
+async def stop_joke_batcher():
+    """Stop the background joke batcher; generate_joke falls back to direct calls."""
+    global _joke_queue, _joke_batcher_task
+    if _joke_batcher_task is not None:
+        _joke_batcher_task.cancel()
+        try:
+            await _joke_batcher_task
+        except asyncio.CancelledError:
+            pass
+    _joke_queue = None
+    _joke_batcher_task = None
+
+
+async def generate_joke(state):
+    """
+    Generate the joke and its explanation in a single LLM call, and pick the autosuggestions.
+    The later explanation/autosuggestion nodes skip their own work when these are already set.
+    When the batcher is running, concurrent requests share one LLM call.
+    """
+    topic = state.get("topic", "general")
+    cache_key = topic.strip().lower()
+    cached = _JOKE_CACHE.get(cache_key, [])
+    if len(cached) >= JOKE_CACHE_POOL_SIZE:
+        logger.info("Using cached joke for topic: %s", topic)
+        return dict(random.choice(cached))
+    
+    try:
+        logger.info("Generating joke and explanation for topic: %s", topic)
+        if _joke_queue is not None:
+            future = asyncio.get_running_loop().create_future()
+            await _joke_queue.put((topic, future))
+            parsed_output = await future
+        else:
+            parsed_output = await _generate_pipeline(topic)
+        logger.info("Joke generated successfully")
+        
+        result = {
             'joke': parsed_output.joke,
+            'explanation': parsed_output.explanation,
+            'autosuggestions': _suggest_actions(parsed_output.joke),
             'status': 'joke_generated'
         }
+        # Re-read the pool: concurrent requests for the topic may have added to it during the call
+        pool = _JOKE_CACHE.get(cache_key, [])
+        if len(pool) < JOKE_CACHE_POOL_SIZE:
+            _JOKE_CACHE[cache_key] = pool + [result]
+        _EXPLANATION_CACHE[result['joke']] = result['explanation']
+        return dict(result)
         
     except Exception as e:
-        print(f"Error generating joke: {str(e)}")
+        logger.error("Error generating joke: %s", e)
         return {
             'joke': f"Sorry, I couldn't generate a joke about {topic} right now.",
             'status': 'error'
         }
 
 
-def generate_explanation(state):
+async def generate_explanation(state):
+    # Already produced together with the joke
+    if state.get("explanation"):
+        return {'status': 'explanation_generated'}
+    
+    joke = state.get("joke", "")
+    cached = _EXPLANATION_CACHE.get(joke)
+    if cached:
+        logger.info("Using cached explanation for joke")
+        return {
+            'explanation': cached,
+            'status': 'explanation_generated'
+        }
+    
     try:
-        llm = get_llm()
-        joke = state.get("joke", "")
-        
-        # Set up output parser
-        parser = PydanticOutputParser(pydantic_object=ExplanationOutput)
-        
-        prompt = f"""Explain why this joke is funny: {joke}
-
-{parser.get_format_instructions()}"""
+        prompt = _EXPLANATION_PROMPT.format_map({"joke": joke})
         
-        print("Generating explanation for joke")
-        response = llm.invoke(prompt)
-        parsed_output = parser.parse(response.content)
-        print("Explanation generated successfully")
+        logger.info("Generating explanation for joke")
+        parsed_output = await get_structured_llm(ExplanationOutput).ainvoke(prompt)
+        logger.info("Explanation generated successfully")
+        _EXPLANATION_CACHE[joke] = parsed_output.explanation
         
         return {
             'explanation': parsed_output.explanation,
@@ -77,130 +263,50 @@ def generate_explanation(state):
         }
         
     except Exception as e:
-        print(f"Error generating explanation: {str(e)}")
+        logger.error("Error generating explanation: %s", e)
         return {
             'explanation': "Sorry, I couldn't generate an explanation for this joke.",
             'status': 'error'
         }
 
 
-def generate_autosuggestions(state):
+async def generate_autosuggestions(state):
     """
     Generate autosuggestions for user interaction after joke and explanation.
-    Uses LLM to select relevant suggestions based on context with Pydantic parsing.
+    Chosen by a fixed rule (_suggest_actions) rather than an LLM call.
     """
-    try:
-        llm = get_llm()
-        topic = state.get("topic", "general")
-        joke = state.get("joke", "")
-        
-        # Define available actions with descriptions
-        available_actions = [
-            {
-                "id": "another_joke",
-                "label": "Tell me another joke about this topic",
-                "description": "Generate a completely new joke about the same topic"
-            },
-            {
-                "id": "simpler_explanation",
-                "label": "Explain this in simpler words",
-                "description": "Rephrase the explanation to be easier to understand"
-            },
-            {
-                "id": "new_topic",
-                "label": "Tell me a joke about a different topic",
-                "description": "Start fresh with a new topic"
-            },
-            {
-                "id": "make_funnier",
-                "label": "Make it funnier",
-                "description": "Enhance the joke to make it more humorous"
-            },
-            {
-                "id": "similar_joke",
-                "label": "Tell me a similar joke",
-                "description": "Generate a joke with similar style or theme"
-            }
-        ]
-        
-        # Set up output parser
-        parser = PydanticOutputParser(pydantic_object=AutosuggestionSelection)
-        
-        # Create action list string
-        actions_str = "\n".join([f"- {action['id']}: {action['description']}" for action in available_actions])
-        
-        prompt = f"""Given this joke about "{topic}": "{joke}"
+    # Already produced together with the joke
+    if state.get("autosuggestions"):
+        return {'status': 'awaiting_action'}
+    
+    suggestions = _suggest_actions(state.get("joke"))
+    logger.info("Generated %s autosuggestions", len(suggestions))
+    
+    return {
+        'autosuggestions': suggestions,
+        'status': 'awaiting_action'
+    }
 
-From the following actions, select the 3-4 most relevant and useful suggestions for the user:
-{actions_str}
 
-{parser.get_format_instructions()}
-
-Select action IDs that would be most helpful and relevant given the context of the joke and topic."""
-        
-        print("Generating autosuggestions...")
-        response = llm.invoke(prompt)
-        
-        try:
-            parsed_output = parser.parse(response.content)
-            selected_ids = parsed_output.selected_action_ids
-            print(f"LLM selected actions: {selected_ids}")
-        except Exception as parse_error:
-            # Fallback: use default suggestions if parsing fails
-            print(f"Could not parse LLM response ({parse_error}), using default suggestions")
-            selected_ids = ["another_joke", "simpler_explanation", "make_funnier"]
-        
-        # Filter available actions based on LLM selection
-        suggestions = [action for action in available_actions if action["id"] in selected_ids]
-        
-        # If no valid suggestions, use defaults
-        if not suggestions:
-            suggestions = available_actions[:3]
-        
-        print(f"Generated {len(suggestions)} autosuggestions")
-        
-        return {
-            'autosuggestions': suggestions,
-            'status': 'awaiting_action'
-        }
-        
-    except Exception as e:
-        print(f"Error generating autosuggestions: {str(e)}")
-        # Return default suggestions on error
-        return {
-            'autosuggestions': [
-                {"id": "another_joke", "label": "Tell me another joke about this topic"},
-                {"id": "simpler_explanation", "label": "Explain this in simpler words"},
-                {"id": "new_topic", "label": "Tell me a joke about a different topic"}
-            ],
-            'status': 'awaiting_action'
-        }
-
-
-def handle_autosuggestion(state):
+async def handle_autosuggestion(state):
     """
     Handle the selected autosuggestion action.
     Routes to appropriate function based on user's choice.
-    Uses Pydantic parsers for structured outputs.
+    Uses the model's native structured output.
     """
     try:
-        llm = get_llm()
         action = state.get("selected_action", "")
         topic = state.get("topic", "general")
         joke = state.get("joke", "")
         explanation = state.get("explanation", "")
         
-        print(f"Handling autosuggestion action: {action}")
+        logger.info("Handling autosuggestion action: %s", action)
         
         if action == "another_joke":
             # Generate a new joke on the same topic
-            parser = PydanticOutputParser(pydantic_object=JokeOutput)
-            prompt = f"""Generate a different funny joke about {topic}. Make it unique and different from this one: {joke}
-
-{parser.get_format_instructions()}"""
+            prompt = _ANOTHER_JOKE_PROMPT.format_map({"topic": topic, "joke": joke})
             
-            response = llm.invoke(prompt)
-            parsed_output = parser.parse(response.content)
+            parsed_output = await get_structured_llm(JokeOutput).ainvoke(prompt)
             
             return {
                 'joke': parsed_output.joke,
@@ -211,29 +317,12 @@ def handle_autosuggestion(state):
             
         elif action == "simpler_explanation":
             # Simplify the explanation and generate new suggestions
-            parser = PydanticOutputParser(pydantic_object=ExplanationOutput)
-            prompt = f"""Rephrase this explanation in very simple, easy-to-understand words suitable for a child: {explanation}
-
-{parser.get_format_instructions()}"""
-            
-            response = llm.invoke(prompt)
-            parsed_output = parser.parse(response.content)
+            prompt = _SIMPLER_EXPLANATION_PROMPT.format_map({"explanation": explanation})
             
-            # Generate new autosuggestions for the simplified explanation
-            available_actions = [
-                {"id": "another_joke", "label": "Tell me another joke about this topic"},
-                {"id": "simpler_explanation", "label": "Explain this in simpler words"},
-                {"id": "new_topic", "label": "Tell me a joke about a different topic"},
-                {"id": "make_funnier", "label": "Make it funnier"},
-                {"id": "similar_joke", "label": "Tell me a similar joke"}
-            ]
+            parsed_output = await get_structured_llm(ExplanationOutput).ainvoke(prompt)
             
             # Select relevant suggestions (default set for simplified explanation)
-            suggestions = [
-                available_actions[0],  # another_joke
-                available_actions[3],  # make_funnier
-                available_actions[4]   # similar_joke
-            ]
+            suggestions = [ACTIONS_BY_ID[i] for i in ("another_joke", "make_funnier", "similar_joke")]
             
             return {
                 'explanation': parsed_output.explanation,
@@ -243,13 +332,9 @@ def handle_autosuggestion(state):
             
         elif action == "make_funnier":
             # Enhance the joke
-            parser = PydanticOutputParser(pydantic_object=JokeOutput)
-            prompt = f"""Make this joke funnier and more entertaining while keeping the same topic ({topic}): {joke}
-
-{parser.get_format_instructions()}"""
+            prompt = _FUNNIER_JOKE_PROMPT.format_map({"topic": topic, "joke": joke})
             
-            response = llm.invoke(prompt)
-            parsed_output = parser.parse(response.content)
+            parsed_output = await get_structured_llm(JokeOutput).ainvoke(prompt)
             
             return {
                 'joke': parsed_output.joke,
@@ -260,13 +345,9 @@ def handle_autosuggestion(state):
             
         elif action == "similar_joke":
             # Generate similar style joke
-            parser = PydanticOutputParser(pydantic_object=JokeOutput)
-            prompt = f"""Generate a joke similar in style and humor to this one, but with different content: {joke}
-
-{parser.get_format_instructions()}"""
+            prompt = _SIMILAR_JOKE_PROMPT.format_map({"joke": joke})
             
-            response = llm.invoke(prompt)
-            parsed_output = parser.parse(response.content)
+            parsed_output = await get_structured_llm(JokeOutput).ainvoke(prompt)
             
             return {
                 'joke': parsed_output.joke,
@@ -282,14 +363,14 @@ def handle_autosuggestion(state):
             }
         
         else:
-            print(f"Unknown action: {action}")
+            logger.warning("Unknown action: %s", action)
             return {
                 'status': 'error',
                 'error': f'Unknown action: {action}'
             }
             
     except Exception as e:
-        print(f"Error handling autosuggestion: {str(e)}")
+        logger.error("Error handling autosuggestion: %s", e)
         return {
             'status': 'error',
             'error': str(e)
@@ -1,10 +1,22 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+import aiosqlite
 from langgraph.graph import StateGraph, START, END
-from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.errors import EmptyInputError
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from .config import CHECKPOINT_DB, CHECKPOINT_TTL_HOURS
 from .models import JokeState
-from .core import generate_joke, generate_explanation, generate_autosuggestions, handle_autosuggestion
+from .core import stream_joke, generate_joke, generate_explanation, generate_autosuggestions, handle_autosuggestion
+
+logger = logging.getLogger(__name__)
+
+# Action results that replace the joke and therefore need a fresh explanation
+JOKE_CHANGED_STATUSES = ('joke_regenerated', 'joke_enhanced', 'similar_joke_generated')
 
 def create_workflow():
-    print("Setting up stateful joke generation workflow with autosuggestions")
+    logger.info("Setting up stateful joke generation workflow with autosuggestions")
     
     # Create the state graph
     graph = StateGraph(JokeState)
@@ -35,7 +47,7 @@ def create_workflow():
         status = state.get('status', '')
         
         # If joke was regenerated/enhanced, go back to explanation
-        if status in ['joke_regenerated', 'joke_enhanced', 'similar_joke_generated']:
+        if status in JOKE_CHANGED_STATUSES:
             return 'generate_explanation'
         # For all other cases (explanation_simplified, new_topic_requested, etc), end workflow
         else:
@@ -50,24 +62,160 @@ def create_workflow():
         }
     )
     
-    # Create in-memory checkpointer
-    checkpointer = InMemorySaver()
-    print("InMemorySaver checkpointer initialized")
-    
+    # No checkpointer here: the LangGraph API server (langgraph.json) supplies its own,
+    # and the FastAPI server attaches a shared SQLite one at startup (open_checkpointer)
     workflow = graph.compile(
-        # checkpointer=checkpointer,
         interrupt_after=['generate_joke', 'generate_autosuggestions', 'handle_autosuggestion']  # Interrupt after all key nodes
     )
-    print("Workflow setup completed with in-memory persistence and autosuggestions")
+    logger.info("Workflow setup completed with autosuggestions")
     
     return workflow
 # Create global workflow instance
 workflow = create_workflow()
 
-def start_joke_generation(topic: str, thread_id: str):
+_checkpoint_conn = None
+_cleanup_task = None
+
+# How often expired threads are deleted
+CLEANUP_INTERVAL_SECONDS = 3600
+
+
+async def open_checkpointer():
+    """
+    Attach a SQLite checkpointer (CHECKPOINT_DB) to the workflow so thread state is
+    shared between server workers and survives restarts, and start the TTL cleanup job.
+    """
+    global _checkpoint_conn, _cleanup_task
+    _checkpoint_conn = await aiosqlite.connect(CHECKPOINT_DB)
+    checkpointer = AsyncSqliteSaver(_checkpoint_conn)
+    await checkpointer.setup()
+    await _checkpoint_conn.execute(
+        "CREATE TABLE IF NOT EXISTS cleanup_runs (id INTEGER PRIMARY KEY CHECK (id = 1), last_run REAL NOT NULL)"
+    )
+    await _checkpoint_conn.execute("INSERT OR IGNORE INTO cleanup_runs (id, last_run) VALUES (1, 0)")
+    await _checkpoint_conn.commit()
+    workflow.checkpointer = checkpointer
+    logger.info("SQLite checkpointer initialized at %s", CHECKPOINT_DB)
+    
+    _cleanup_task = asyncio.create_task(_cleanup_loop(checkpointer))
+
+
+async def close_checkpointer():
+    """Stop the cleanup job and close the SQLite connection."""
+    global _checkpoint_conn, _cleanup_task
+    if _cleanup_task is not None:
+        _cleanup_task.cancel()
+        try:
+            await _cleanup_task
+        except asyncio.CancelledError:
+            pass
+    if _checkpoint_conn is not None:
+        await _checkpoint_conn.close()
+    workflow.checkpointer = None
+    _checkpoint_conn = None
+    _cleanup_task = None
+
+
+async def delete_expired_threads(checkpointer, max_age_hours: float):
+    """Delete every thread whose latest checkpoint is older than max_age_hours."""
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=max_age_hours)
+    
+    async with checkpointer.lock:
+        async with checkpointer.conn.execute("SELECT DISTINCT thread_id FROM checkpoints") as cursor:
+            thread_ids = [row[0] for row in await cursor.fetchall()]
+    
+    deleted = 0
+    for thread_id in thread_ids:
+        latest = await checkpointer.aget_tuple({"configurable": {"thread_id": thread_id}})
+        if latest and datetime.fromisoformat(latest.checkpoint["ts"]) < cutoff:
+            await checkpointer.adelete_thread(thread_id)
+            deleted += 1
+    
+    return deleted
+
+
+async def _claim_cleanup_run(checkpointer) -> bool:
+    """
+    Record a cleanup run in the shared database unless one happened within the last
+    CLEANUP_INTERVAL_SECONDS, so only one of the server workers does each run.
+    """
+    now = time.time()
+    async with checkpointer.lock:
+        cursor = await checkpointer.conn.execute(
+            "UPDATE cleanup_runs SET last_run = ? WHERE id = 1 AND last_run <= ?",
+            (now, now - CLEANUP_INTERVAL_SECONDS)
+        )
+        await checkpointer.conn.commit()
+        return cursor.rowcount == 1
+
+
+async def _cleanup_loop(checkpointer):
+    """Run delete_expired_threads once per CLEANUP_INTERVAL_SECONDS across all workers."""
+    while True:
+        try:
+            if await _claim_cleanup_run(checkpointer):
+                deleted = await delete_expired_threads(checkpointer, CHECKPOINT_TTL_HOURS)
+                if deleted:
+                    logger.info("Deleted %s threads older than %s hours", deleted, CHECKPOINT_TTL_HOURS)
+        except Exception as e:
+            logger.error("Error cleaning up expired threads: %s", e)
+        await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
+
+# Explanations being generated speculatively while the user is reading a new joke,
+# keyed by thread_id. Each task saves its explanation to the thread's checkpoint, so
+# /continue on any worker finds it, and removes itself from the dict when done
+_pending_explanations: dict[str, asyncio.Task] = {}
+
+
+async def _prefetch_and_save_explanation(thread_id: str, joke: str, paused_after: str):
+    """
+    Generate the explanation for a joke and save it as the output of the node the
+    thread is paused after, so the generate_explanation node finds it already set.
+    """
     try:
+        explanation_update = await generate_explanation({'joke': joke})
+        if explanation_update.get('status') == 'error':
+            return
+        
+        # Skip the save if the thread has moved on meanwhile (e.g. a request on another worker)
         config = {"configurable": {"thread_id": thread_id}}
-        print(f"Starting joke generation for topic: {topic}, thread: {thread_id}")
+        current_state = await workflow.aget_state(config)
+        if (current_state.values.get('joke') != joke or current_state.values.get('explanation')
+                or current_state.next != ('generate_explanation',)):
+            return
+        
+        await workflow.aupdate_state(
+            config,
+            {'explanation': explanation_update['explanation']},
+            as_node=paused_after
+        )
+    except Exception as e:
+        logger.error("Error prefetching explanation for thread %s: %s", thread_id, e)
+
+
+def _prefetch_explanation(thread_id: str, joke: str, paused_after: str):
+    """Start generating the explanation for a joke before /continue asks for it."""
+    _discard_prefetched_explanation(thread_id)
+    task = asyncio.create_task(_prefetch_and_save_explanation(thread_id, joke, paused_after))
+    _pending_explanations[thread_id] = task
+    
+    def _evict(done_task):
+        if _pending_explanations.get(thread_id) is done_task:
+            del _pending_explanations[thread_id]
+    task.add_done_callback(_evict)
+
+
+def _discard_prefetched_explanation(thread_id: str):
+    """Cancel a prefetch whose joke is about to be replaced."""
+    pending = _pending_explanations.pop(thread_id, None)
+    if pending is not None:
+        pending.cancel()
+
+async def start_joke_generation(topic: str, thread_id: str):
+    try:
+        config = {"configurable": {"thread_id": thread_id}}
+        logger.info("Starting joke generation for topic: %s, thread: %s", topic, thread_id)
+        _discard_prefetched_explanation(thread_id)
         
         # Initial state
         initial_state = {
@@ -79,8 +227,8 @@ def start_joke_generation(topic: str, thread_id: str):
             'status': 'started'
         }
         
-        result = workflow.invoke(initial_state, config=config)
-        print(f"Joke generation completed for thread: {thread_id}")
+        result = await workflow.ainvoke(initial_state, config=config)
+        logger.info("Joke generation completed for thread: %s", thread_id)
         
         return {
             'topic': result.get('topic'),
@@ -89,28 +237,66 @@ def start_joke_generation(topic: str, thread_id: str):
             'thread_id': thread_id
         }
     except Exception as e:
-        print(f"Error in start_joke_generation: {str(e)}")
+        logger.error("Error in start_joke_generation: %s", e)
         raise
 
 
-def continue_with_explanation(thread_id: str):
+async def stream_joke_generation(topic: str, thread_id: str):
+    """
+    Streaming variant of start_joke_generation: yields the joke text as it is generated,
+    then saves it to the thread as if generate_joke had run so /continue picks up from there.
+    """
+    config = {"configurable": {"thread_id": thread_id}}
+    logger.info("Streaming joke generation for topic: %s, thread: %s", topic, thread_id)
+    _discard_prefetched_explanation(thread_id)
+    
+    parts = []
+    async for text in stream_joke(topic):
+        parts.append(text)
+        yield text
+    joke = "".join(parts).strip()
+    
+    await workflow.aupdate_state(
+        config,
+        {
+            'topic': topic,
+            'joke': joke,
+            'explanation': None,
+            'autosuggestions': None,
+            'selected_action': None,
+            'status': 'joke_generated'
+        },
+        as_node='generate_joke'
+    )
+    logger.info("Streamed joke saved for thread: %s", thread_id)
+    
+    # The explanation wasn't produced with the joke, so start it while the user reads
+    _prefetch_explanation(thread_id, joke, 'generate_joke')
+
+
+async def continue_with_explanation(thread_id: str):
     try:
         config = {"configurable": {"thread_id": thread_id}}
-        print(f"Continuing workflow for thread: {thread_id}")
+        logger.info("Continuing workflow for thread: %s", thread_id)
         
-        # Get current state to verify it exists
-        current_state = workflow.get_state(config)
+        # Let a prefetch running in this worker finish saving its explanation
+        # instead of calling the LLM again
+        prefetched = _pending_explanations.get(thread_id)
+        if prefetched is not None:
+            try:
+                await asyncio.shield(prefetched)
+            except asyncio.CancelledError:
+                # Discarded by a concurrent request; only propagate if this request was cancelled
+                if not prefetched.cancelled():
+                    raise
         
-        if not current_state or not current_state.values:
+        # Continue from where we left off (None means continue with no new input);
+        # on a thread with no checkpoint there is nothing to resume
+        try:
+            result = await workflow.ainvoke(None, config=config)
+        except EmptyInputError:
             raise ValueError(f"No active workflow found for thread_id: {thread_id}")
-        
-        # Check if joke exists
-        if not current_state.values.get('joke'):
-            raise ValueError(f"No joke found for thread_id: {thread_id}. Start workflow first.")
-        
-        # Continue from where we left off (None means continue with no new input)
-        result = workflow.invoke(None, config=config)
-        print(f"Explanation and autosuggestions generated for thread: {thread_id}")
+        logger.info("Explanation and autosuggestions generated for thread: %s", thread_id)
         
         return {
             'topic': result.get('topic'),
@@ -121,11 +307,11 @@ def continue_with_explanation(thread_id: str):
             'thread_id': thread_id
         }
     except Exception as e:
-        print(f"Error in continue_with_explanation: {str(e)}")
+        logger.error("Error in continue_with_explanation: %s", e)
         raise
 
 
-def handle_user_action(thread_id: str, action: str):
+async def handle_user_action(thread_id: str, action: str):
     """
     Handle user's selected autosuggestion action.
     
@@ -135,23 +321,37 @@ def handle_user_action(thread_id: str, action: str):
     """
     try:
         config = {"configurable": {"thread_id": thread_id}}
-        print(f"Handling user action '{action}' for thread: {thread_id}")
+        logger.info("Handling user action '%s' for thread: %s", action, thread_id)
+        _discard_prefetched_explanation(thread_id)
         
-        # Get current state
-        current_state = workflow.get_state(config)
-        
-        if not current_state or not current_state.values:
+        current_state = await workflow.aget_state(config)
+        if not current_state.values:
             raise ValueError(f"No active workflow found for thread_id: {thread_id}")
         
-        # Update state with selected action
-        updated_state = {
-            **current_state.values,
-            'selected_action': action
-        }
+        if action == 'new_topic':
+            # Nothing to generate: save the outcome as handle_autosuggestion's output
+            # (which ends the workflow) instead of running the node
+            update = {'selected_action': action, 'status': 'new_topic_requested'}
+            await workflow.aupdate_state(config, update, as_node='handle_autosuggestion')
+            result = {**current_state.values, **update}
+        else:
+            # Write only the selected action, then resume the interrupted workflow
+            if current_state.next == ('handle_autosuggestion',):
+                await workflow.aupdate_state(config, {'selected_action': action})
+            elif not current_state.next:
+                # The previous action ended the workflow (e.g. simpler_explanation):
+                # re-enter it just before handle_autosuggestion
+                await workflow.aupdate_state(config, {'selected_action': action}, as_node='generate_autosuggestions')
+            else:
+                raise ValueError(
+                    f"Thread {thread_id} is not waiting for an action (next step: {current_state.next[0]}). "
+                    "Call /continue first."
+                )
+            result = await workflow.ainvoke(None, config=config)
+        logger.info("Action '%s' completed for thread: %s", action, thread_id)
         
-        # Continue workflow with the action
-        result = workflow.invoke(updated_state, config=config)
-        print(f"Action '{action}' completed for thread: {thread_id}")
+        if result.get('status') in JOKE_CHANGED_STATUSES:
+            _prefetch_explanation(thread_id, result.get('joke'), 'handle_autosuggestion')
         
         return {
             'topic': result.get('topic'),
@@ -163,14 +363,14 @@ def handle_user_action(thread_id: str, action: str):
             'action_performed': action
         }
     except Exception as e:
-        print(f"Error in handle_user_action: {str(e)}")
+        logger.error("Error in handle_user_action: %s", e)
         raise
 
 
-def get_thread_status(thread_id: str):
+async def get_thread_status(thread_id: str):
     try:
         config = {"configurable": {"thread_id": thread_id}}
-        state = workflow.get_state(config)
+        state = await workflow.aget_state(config)
         
         if not state or not state.values:
             return {
@@ -190,5 +390,5 @@ def get_thread_status(thread_id: str):
             'next_node': state.next[0] if state.next else None
         }
     except Exception as e:
-        print(f"Error in get_thread_status: {str(e)}")
+        logger.error("Error in get_thread_status: %s", e)
         raise
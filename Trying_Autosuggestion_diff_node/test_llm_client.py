@@ -0,0 +1,42 @@
+"""
+Checks that LLM calls go through the pooled HTTP/2 httpx transport from src/config.py
+(and not through aiohttp, which google-genai prefers when it is installed).
+No server or network access needed: run with python test_llm_client.py or pytest.
+"""
+
+import asyncio
+import os
+
+os.environ.setdefault("GOOGLE_API_KEY", "test-key")
+
+from src.config import get_llm, close_llm, LLMHTTPTransport
+
+
+def _api_client():
+    # google-genai's internal client, which picks the HTTP library for each call
+    return get_llm().client._api_client
+
+
+def test_async_calls_use_httpx():
+    """Async calls (ainvoke/astream) must not be routed through aiohttp."""
+    assert not _api_client()._use_aiohttp()
+
+
+def test_httpx_clients_use_pooled_http2_transport():
+    """Both httpx clients are built on the configured HTTP/2 transport."""
+    api_client = _api_client()
+    transport = api_client._async_httpx_client._transport
+    assert isinstance(transport, LLMHTTPTransport)
+    assert api_client._httpx_client._transport is transport
+    assert transport._async._pool._http2
+
+
+if __name__ == "__main__":
+    tests = [test_async_calls_use_httpx, test_httpx_clients_use_pooled_http2_transport]
+    for test in tests:
+        try:
+            test()
+            print(f"{test.__name__:.<60} ✅ PASSED")
+        except AssertionError:
+            print(f"{test.__name__:.<60} ❌ FAILED")
+    asyncio.run(close_llm())
@@ -1,7 +1,18 @@
+import json
+import logging
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import uvicorn
-from src.graph import start_joke_generation, continue_with_explanation, get_thread_status, handle_user_action
+from src.config import setup_logging
+
+# Configure logging before the workflow is built so its setup messages are kept
+setup_logging()
+
+from src.graph import start_joke_generation, continue_with_explanation, stream_continue_with_explanation, get_thread_status, handle_user_action, open_checkpointer, close_checkpointer
+from src.core import start_joke_batcher, stop_joke_batcher
+
+logger = logging.getLogger(__name__)
 
 # Create stateful FastAPI app
 app = FastAPI(
@@ -10,6 +21,17 @@ app = FastAPI(
     description="API with persistent state management, interrupts, and smart autosuggestions"
 )
 
+@app.on_event("startup")
+async def startup_event():
+    await open_checkpointer()
+    # Coalesce concurrent /start requests into batched LLM calls
+    start_joke_batcher()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await stop_joke_batcher()
+    await close_checkpointer()
+
 # Request models
 class StartRequest(BaseModel):
     topic: str
@@ -26,7 +48,7 @@ class ActionRequest(BaseModel):
     action: str  # The autosuggestion action ID selected by user
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {
         "message": "Stateful Joke Generation API with Autosuggestions is running!",
         "version": "3.0.0",
@@ -34,20 +56,21 @@ def read_root():
             "/health",
             "/start - Start joke generation",
             "/continue - Generate explanation and autosuggestions",
+            "/continue/stream - Generate explanation and autosuggestions, streamed as Server-Sent Events",
             "/action - Handle user's selected autosuggestion",
             "/status - Check thread status"
         ]
     }
 
 @app.get("/health")
-def health_check():
+async def health_check():
     return {"status": "healthy", "persistence": "InMemory", "features": ["interrupts", "autosuggestions"]}
 
 @app.post("/start")
-def start_endpoint(request: StartRequest):
+async def start_endpoint(request: StartRequest):
     try:
-        print(f"API /start - topic: {request.topic}, thread: {request.thread_id}")
-        result = start_joke_generation(request.topic, request.thread_id)
+        logger.info("API /start - topic: %s, thread: %s", request.topic, request.thread_id)
+        result = await start_joke_generation(request.topic, request.thread_id)
         
         return {
             "success": True,
@@ -58,14 +81,14 @@ def start_endpoint(request: StartRequest):
             "message": "Joke generated. Call /continue to get explanation."
         }
     except Exception as e:
-        print(f"API error in /start: {str(e)}")
+        logger.error("API error in /start: %s", e)
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 @app.post("/continue")
-def continue_endpoint(request: ContinueRequest):
+async def continue_endpoint(request: ContinueRequest):
     try:
-        print(f"API /continue - thread: {request.thread_id}")
-        result = continue_with_explanation(request.thread_id)
+        logger.info("API /continue - thread: %s", request.thread_id)
+        result = await continue_with_explanation(request.thread_id)
         
         return {
             "success": True,
@@ -78,15 +101,64 @@ def continue_endpoint(request: ContinueRequest):
             "message": "Explanation and autosuggestions generated. Use /action to select an autosuggestion."
         }
     except ValueError as e:
-        print(f"API validation error in /continue (Invalid thread id): {str(e)}")
+        logger.warning("API validation error in /continue (Invalid thread id): %s", e)
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
-        print(f"API error in /continue: {str(e)}")
+        logger.error("API error in /continue: %s", e)
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+@app.post("/continue/stream")
+async def continue_stream_endpoint(request: ContinueRequest):
+    """
+    Same as /continue, but streams the explanation text as Server-Sent Events while it is
+    generated. Each event's data is JSON: {"token": ...} per chunk, then a final "done"
+    event with the same payload as /continue (or an "error" event).
+    """
+    logger.info("API /continue/stream - thread: %s", request.thread_id)
+    stream = stream_continue_with_explanation(request.thread_id)
+    
+    # Check the thread before the response starts, so an invalid one is still a 404
+    try:
+        first = await anext(stream)
+    except ValueError as e:
+        logger.warning("API validation error in /continue/stream (Invalid thread id): %s", e)
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error("API error in /continue/stream: %s", e)
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+    
+    async def event_stream():
+        try:
+            item = first
+            while True:
+                if isinstance(item, dict):
+                    done = {
+                        "success": True,
+                        **item,
+                        "message": "Explanation and autosuggestions generated. Use /action to select an autosuggestion."
+                    }
+                    yield f"event: done\ndata: {json.dumps(done)}\n\n"
+                    return
+                yield f"data: {json.dumps({'token': item})}\n\n"
+                item = await anext(stream)
+        except Exception as e:
+            logger.error("API error in /continue/stream: %s", e)
+            yield f"event: error\ndata: {json.dumps({'detail': f'Error: {str(e)}'})}\n\n"
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+# Response message for each /action result status
+_ACTION_MESSAGES = {
+    "joke_regenerated": "New joke generated! Call /continue to get explanation and new suggestions.",
+    "joke_enhanced": "New joke generated! Call /continue to get explanation and new suggestions.",
+    "similar_joke_generated": "New joke generated! Call /continue to get explanation and new suggestions.",
+    "explanation_simplified": "Explanation simplified with new autosuggestions! Select another action or call /start for a new topic.",
+    "new_topic_requested": "Session completed. Call /start with a new topic."
+}
 
 @app.post("/action")
-def action_endpoint(request: ActionRequest):
+async def action_endpoint(request: ActionRequest):
     """
     Handle user's selected autosuggestion action.
     
@@ -98,8 +170,8 @@ def action_endpoint(request: ActionRequest):
     - new_topic: Request a new topic (returns completed status)
     """
     try:
-        print(f"API /action - thread: {request.thread_id}, action: {request.action}")
-        result = handle_user_action(request.thread_id, request.action)
+        logger.info("API /action - thread: %s, action: %s", request.thread_id, request.action)
+        result = await handle_user_action(request.thread_id, request.action)
         
         response = {
             "success": True,
@@ -113,32 +185,22 @@ def action_endpoint(request: ActionRequest):
         }
         
         # Add appropriate message based on status
-        if result['status'] in ['joke_regenerated', 'joke_enhanced', 'similar_joke_generated']:
-            response["message"] = "New joke generated! Call /continue to get explanation and new suggestions."
-        elif result['status'] == 'explanation_simplified':
-            response["message"] = "Explanation simplified with new autosuggestions! Select another action or call /start for a new topic."
-        elif result['status'] == 'new_topic_requested':
-            response["message"] = "Session completed. Call /start with a new topic."
-        else:
-            response["message"] = "Action completed."
-            response["message"] = "Session completed. Call /start with a new topic."
-        else:
-            response["message"] = "Action completed."
+        response["message"] = _ACTION_MESSAGES.get(result['status'], "Action completed.")
         
         return response
         
     except ValueError as e:
-        print(f"API validation error in /action: {str(e)}")
+        logger.warning("API validation error in /action: %s", e)
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
-        print(f"API error in /action: {str(e)}")
+        logger.error("API error in /action: %s", e)
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 @app.post("/status")
-def status_endpoint(request: StatusRequest):
+async def status_endpoint(request: StatusRequest):
     try:
-        print(f"API /status - thread: {request.thread_id}")
-        result = get_thread_status(request.thread_id)
+        logger.info("API /status - thread: %s", request.thread_id)
+        result = await get_thread_status(request.thread_id)
         
         if not result.get('exists'):
             raise HTTPException(status_code=404, detail=result.get('message'))
@@ -150,7 +212,7 @@ def status_endpoint(request: StatusRequest):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"API error in /status: {str(e)}")
+        logger.error("API error in /status: %s", e)
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 # if __name__ == "__main__":
@@ -0,0 +1,117 @@
+"""Response cache for LLM calls, with exact and semantic (embedding similarity) lookup."""
+
+import hashlib
+import json
+import logging
+import time
+import numpy as np
+from .config import get_embeddings, LLM_CACHE_ENABLED, LLM_CACHE_TTL_SECONDS, SEMANTIC_CACHE_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+
+class LLMCache:
+    """
+    Cache of LLM results keyed on a function name and its text inputs.
+    
+    A lookup first tries the exact key. On a miss, and only for calls made with
+    semantic=True, the inputs are embedded and the cached entry of the same function
+    with the highest cosine similarity is reused if it reaches the threshold. That is
+    only safe when any similar input may share a result (e.g. a joke for a topic), not
+    when the result belongs to one specific input (e.g. an explanation of a given joke).
+    Entries expire after ttl seconds; when the cache is full the oldest entry is dropped.
+    """
+    
+    def __init__(self, ttl: float, threshold: float, max_entries: int = 1024, enabled: bool = True):
+        self.ttl = ttl
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.enabled = enabled
+        # key -> (expires_at, fn_name, normalized embedding or None, value), oldest first
+        self._entries = {}
+    
+    @staticmethod
+    def cache_key(fn_name, *inputs):
+        """Exact-match key for a call: sha256 of the function name and inputs."""
+        return hashlib.sha256(json.dumps([fn_name, *inputs], sort_keys=True).encode()).hexdigest()
+    
+    async def _embed(self, inputs):
+        """Embed the inputs as one text, normalized so a dot product is the cosine similarity."""
+        vector = np.asarray(await get_embeddings().aembed_query("\n".join(inputs)))
+        return vector / np.linalg.norm(vector)
+    
+    def _evict_expired(self):
+        now = time.monotonic()
+        for key in [key for key, entry in self._entries.items() if entry[0] <= now]:
+            del self._entries[key]
+    
+    def _semantic_match(self, fn_name, embedding):
+        """Return the most similar entry's value for fn_name, if it reaches the threshold."""
+        candidates = [entry for entry in self._entries.values() if entry[1] == fn_name and entry[2] is not None]
+        if not candidates:
+            return None
+        
+        similarities = np.stack([entry[2] for entry in candidates]) @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.threshold:
+            return candidates[best][3]
+        return None
+    
+    def _store(self, key, fn_name, embedding, value):
+        if len(self._entries) >= self.max_entries:
+            del self._entries[next(iter(self._entries))]
+        self._entries[key] = (time.monotonic() + self.ttl, fn_name, embedding, value)
+    
+    def get(self, fn_name, inputs):
+        """Return the exact-match cached value of fn_name for inputs, or None."""
+        if not self.enabled:
+            return None
+        
+        self._evict_expired()
+        entry = self._entries.get(self.cache_key(fn_name, *inputs))
+        return entry[3] if entry is not None else None
+    
+    def set(self, fn_name, inputs, value):
+        """Cache value as the result of fn_name for inputs (exact match only)."""
+        if self.enabled:
+            self._store(self.cache_key(fn_name, *inputs), fn_name, None, value)
+    
+    async def cached(self, fn_name, inputs, compute, semantic=False):
+        """
+        Return the cached result of fn_name for inputs, or await compute() and cache it.
+        With semantic=True, results cached for similar inputs are reused too.
+        """
+        if not self.enabled:
+            return await compute()
+        
+        self._evict_expired()
+        key = self.cache_key(fn_name, *inputs)
+        if key in self._entries:
+            logger.debug("LLM cache hit (exact) for %s", fn_name)
+            return self._entries[key][3]
+        
+        embedding = None
+        if semantic:
+            try:
+                embedding = await self._embed(inputs)
+            except Exception as e:
+                # Embedding is only an optimization; fall back to exact matching
+                logger.warning("Could not embed cache inputs for %s: %s", fn_name, e)
+        
+        if embedding is not None:
+            value = self._semantic_match(fn_name, embedding)
+            if value is not None:
+                logger.debug("LLM cache hit (semantic) for %s", fn_name)
+                return value
+        
+        value = await compute()
+        self._store(key, fn_name, embedding, value)
+        return value
+
+
+# Shared by all nodes in the process
+llm_cache = LLMCache(ttl=LLM_CACHE_TTL_SECONDS, threshold=SEMANTIC_CACHE_THRESHOLD, enabled=LLM_CACHE_ENABLED)
+
+# Responses derived from a joke that are valid for any request about that joke (e.g. its
+# simplified explanation), so unlike llm_cache they are reused at any temperature
+derived_cache = LLMCache(ttl=LLM_CACHE_TTL_SECONDS, threshold=SEMANTIC_CACHE_THRESHOLD)
@@ -1,22 +1,96 @@
 """Simple configuration for the joke agent."""
 
+import atexit
+import logging
 import os
+import queue
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 
 # Load environment variables
 load_dotenv()
 
 # Simple configuration
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-MODEL_NAME = os.getenv("MODEL_NAME", "gemma-3-27b-it")
+# Must support JSON-schema responses (Gemma models don't), since every call uses structured output
+MODEL_NAME = os.getenv("MODEL_NAME", "gemini-2.5-flash")
+# Per-step progress messages from the nodes and the cache are logged at DEBUG
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "models/gemini-embedding-001")
 
+# Sampling temperature (the client's default when unset). LLM responses are only
+# cached when it is 0, since otherwise the same prompt is expected to vary
+LLM_TEMPERATURE = float(os.environ["LLM_TEMPERATURE"]) if "LLM_TEMPERATURE" in os.environ else None
+LLM_CACHE_ENABLED = LLM_TEMPERATURE == 0
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "3600"))
+# Minimum cosine similarity for a cached response to be reused for different inputs
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+# Number of recent action results each thread keeps for exact repeats (same rule: temperature 0 only)
+ACTION_CACHE_SIZE = int(os.getenv("ACTION_CACHE_SIZE", "16"))
+
+# Request coalescing for /start: up to JOKE_BATCH_SIZE topics arriving within
+# JOKE_BATCH_WINDOW_MS of each other are sent to the LLM as one prompt
+JOKE_BATCH_SIZE = int(os.getenv("JOKE_BATCH_SIZE", "8"))
+JOKE_BATCH_WINDOW_MS = float(os.getenv("JOKE_BATCH_WINDOW_MS", "20"))
+
+def setup_logging():
+    """
+    Configure root logging at LOG_LEVEL through a QueueHandler, with a QueueListener
+    thread doing the actual stdout writes so request handlers never block on I/O.
+    Does nothing if the root logger is already configured.
+    """
+    if logging.getLogger().handlers:
+        return
+    
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = QueueListener(log_queue, stream_handler)
+    
+    # The queue handler only merges args into the message; the stream handler does the formatting
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    
+    logging.basicConfig(level=LOG_LEVEL, handlers=[queue_handler])
+    listener.start()
+    atexit.register(listener.stop)
+
+@lru_cache(maxsize=1)
 def get_llm():
-    """Get the language model."""
+    """Get the language model (built once per process and reused)."""
     if not GOOGLE_API_KEY:
         raise ValueError("GOOGLE_API_KEY environment variable is required")
     
+    kwargs = {}
+    if LLM_TEMPERATURE is not None:
+        kwargs["temperature"] = LLM_TEMPERATURE
+    
     return ChatGoogleGenerativeAI(
         model=MODEL_NAME,
+        google_api_key=GOOGLE_API_KEY,
+        **kwargs
+    )
+
+
+@lru_cache(maxsize=1)
+def get_embeddings():
+    """Get the embedding model used by the semantic response cache (built once per process)."""
+    if not GOOGLE_API_KEY:
+        raise ValueError("GOOGLE_API_KEY environment variable is required")
+    
+    return GoogleGenerativeAIEmbeddings(
+        model=EMBEDDING_MODEL,
         google_api_key=GOOGLE_API_KEY
     )
+
+
+@lru_cache(maxsize=None)
+def get_structured_llm(model_cls):
+    """
+    Get the language model bound to a Pydantic output schema (one instance per schema).
+    The schema is enforced by the provider's native JSON schema mode, so prompts don't
+    need format instructions.
+    """
+    return get_llm().with_structured_output(model_cls, method="json_schema")
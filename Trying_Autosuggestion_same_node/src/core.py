@@ -1,7 +1,14 @@
-from .config import get_llm
-from pydantic import BaseModel, Field
-from langchain_core.output_parsers import PydanticOutputParser
-from typing import List
+import asyncio
+import hashlib
+import logging
+from .config import get_llm, get_structured_llm, JOKE_BATCH_SIZE, JOKE_BATCH_WINDOW_MS, LLM_CACHE_ENABLED, ACTION_CACHE_SIZE
+from .cache import llm_cache, derived_cache
+from pydantic import BaseModel, Field, ValidationError, conlist
+from langchain_core.exceptions import OutputParserException
+from langchain_core.utils.json import parse_partial_json
+from typing import List, Literal
+
+logger = logging.getLogger(__name__)
 
 
 # Pydantic models for structured outputs
@@ -10,32 +17,214 @@ class JokeOutput(BaseModel):
     joke: str = Field(description="A funny joke about the given topic")
 
 
+class JokeBatchOutput(BaseModel):
+    """Model for a batch of jokes, one per requested topic"""
+    items: List[JokeOutput] = Field(description="One joke per topic, in the same order as the topics")
+
+
+# Ids of the actions in AVAILABLE_ACTIONS; as a schema enum the LLM can only select valid ones
+ActionId = Literal["another_joke", "simpler_explanation", "new_topic", "make_funnier", "similar_joke"]
+
+
 class ExplanationWithSuggestions(BaseModel):
     """Model for combined explanation and autosuggestions output"""
     explanation: str = Field(description="An explanation of why the joke is funny")
-    selected_action_ids: List[str] = Field(
-        description="List of 3-4 selected action IDs in order of relevance for user interaction",
-        min_items=3,
-        max_items=4
+    selected_action_ids: conlist(ActionId, min_length=3, max_length=4) = Field(
+        description="List of 3-4 selected action IDs in order of relevance for user interaction"
     )
 
 
-def generate_joke(state):
-    try:
-        llm = get_llm()
-        topic = state.get("topic", "general")
+class JokeWithExplanationAndSuggestions(BaseModel):
+    """Model for a new joke together with its explanation and autosuggestions"""
+    joke: str = Field(description="The new joke")
+    explanation: str = Field(description="An explanation of why the new joke is funny")
+    selected_action_ids: conlist(ActionId, min_length=3, max_length=4) = Field(
+        description="List of 3-4 selected action IDs in order of relevance for user interaction"
+    )
+
+
+# Actions the user can pick from after a joke has been explained
+AVAILABLE_ACTIONS = (
+    {
+        "id": "another_joke",
+        "label": "Tell me another joke about this topic",
+        "description": "Generate a completely new joke about the same topic"
+    },
+    {
+        "id": "simpler_explanation",
+        "label": "Explain this in simpler words",
+        "description": "Rephrase the explanation to be easier to understand"
+    },
+    {
+        "id": "new_topic",
+        "label": "Tell me a joke about a different topic",
+        "description": "Start fresh with a new topic"
+    },
+    {
+        "id": "make_funnier",
+        "label": "Make it funnier",
+        "description": "Enhance the joke to make it more humorous"
+    },
+    {
+        "id": "similar_joke",
+        "label": "Tell me a similar joke",
+        "description": "Generate a joke with similar style or theme"
+    }
+)
+
+# JSON schema for the streamed explanation call, which can't go through get_structured_llm
+_COMBO_SCHEMA = ExplanationWithSuggestions.model_json_schema()
+
+# Action lists as they appear in prompts, built once so the prompt prefix is identical on every
+# call. The descriptions live in the system message of the calls that pick suggestions, ahead of
+# everything that varies per request; the user messages only list the ids
+ACTIONS_STATIC_DOC = "\n".join([f"- {action['id']}: {action['description']}" for action in AVAILABLE_ACTIONS])
+ACTION_IDS = ", ".join([action["id"] for action in AVAILABLE_ACTIONS])
+
+_SUGGESTIONS_SYSTEM_PROMPT = f"""You explain jokes and suggest what the user could do next.
+
+These are the actions you can suggest:
+{ACTIONS_STATIC_DOC}
+
+Select the 3-4 actions most relevant and useful for the user based on the joke and its explanation."""
+
+_ACTIONS_BY_ID = {action["id"]: action for action in AVAILABLE_ACTIONS}
+
+# Suggested when the LLM's selection can't be used
+DEFAULT_ACTION_IDS = ("another_joke", "simpler_explanation", "make_funnier")
+
+
+def _select_suggestions(selected_ids):
+    """
+    Return the actions for the selected ids, in the LLM's order of relevance (ids are valid
+    by schema). The schema can't rule out repeated ids, so after dropping repeats the list
+    is topped up from DEFAULT_ACTION_IDS to keep at least 3 suggestions.
+    """
+    action_ids = list(dict.fromkeys(selected_ids))
+    for action_id in DEFAULT_ACTION_IDS:
+        if len(action_ids) >= 3:
+            break
+        if action_id not in action_ids:
+            action_ids.append(action_id)
+    return [_ACTIONS_BY_ID[action_id] for action_id in action_ids]
+
+
+async def _generate_joke_single(topic):
+    """Generate one joke about topic."""
+    # Static instructions first and per-request values last, so repeated calls share
+    # a prompt prefix the provider can cache
+    prompt = f"""Generate a funny joke about the topic given at the end.
+
+Topic: {topic}"""
+    
+    return await get_structured_llm(JokeOutput).ainvoke(prompt)
+
+
+async def _generate_jokes_batch(topics):
+    """Generate jokes for several topics in one LLM call, one output per topic."""
+    if len(topics) == 1:
+        return [await _generate_joke_single(topics[0])]
+    
+    topics_str = "\n".join([f"{i}. {topic}" for i, topic in enumerate(topics, start=1)])
+    prompt = f"""Generate a funny joke about each of the topics given at the end.
+Return exactly one item per topic, in the same order as the topics.
+
+Topics:
+{topics_str}"""
+    
+    items = (await get_structured_llm(JokeBatchOutput).ainvoke(prompt)).items
+    if len(items) != len(topics):
+        raise ValueError(f"Expected {len(topics)} batch items, got {len(items)}")
+    return items
+
+
+async def joke_batcher_loop(queue):
+    """
+    Coalesce concurrent joke requests from the queue into batched LLM calls.
+    Each queue item is a (topic, future) pair; the future receives that topic's output.
+    """
+    loop = asyncio.get_running_loop()
+    window = JOKE_BATCH_WINDOW_MS / 1000
+    
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + window
+        
+        # Collect whatever else arrives within the batching window
+        while len(batch) < JOKE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
         
-        # Set up output parser
-        parser = PydanticOutputParser(pydantic_object=JokeOutput)
+        topics = [topic for topic, _ in batch]
+        logger.debug("Generating jokes for batch of %s topics: %s", len(topics), topics)
+        
+        try:
+            results = await _generate_jokes_batch(topics)
+        except Exception as e:
+            # Fall back to one call per topic so a single bad item doesn't fail the whole batch
+            logger.warning("Batched joke generation failed (%s), retrying per topic", e)
+            results = await asyncio.gather(*[_generate_joke_single(topic) for topic in topics], return_exceptions=True)
         
-        prompt = f"""Generate a funny joke about {topic}.
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
 
-{parser.get_format_instructions()}"""
+
+_joke_queue = None
+_joke_batcher_task = None
+
+
+def start_joke_batcher():
+    """Start the background joke batcher on the running event loop."""
+    global _joke_queue, _joke_batcher_task
+    _joke_queue = asyncio.Queue()
+    _joke_batcher_task = asyncio.create_task(joke_batcher_loop(_joke_queue))
+
+
+async def stop_joke_batcher():
+    """Stop the background joke batcher; generate_joke falls back to direct calls."""
+    global _joke_queue, _joke_batcher_task
+    if _joke_batcher_task is not None:
+        _joke_batcher_task.cancel()
+        try:
+            await _joke_batcher_task
+        except asyncio.CancelledError:
+            pass
+    _joke_queue = None
+    _joke_batcher_task = None
+
+
+async def _request_joke(topic):
+    """Get a joke through the batcher when it is running, otherwise with a direct call."""
+    if _joke_queue is None:
+        return await _generate_joke_single(topic)
+    
+    future = asyncio.get_running_loop().create_future()
+    await _joke_queue.put((topic, future))
+    return await future
+
+
+async def generate_joke(state):
+    """
+    Generate a joke about the state's topic.
+    When the batcher is running, concurrent requests share one LLM call.
+    """
+    try:
+        topic = state.get("topic", "general")
         
-        print(f"Generating joke for topic: {topic}")
-        response = llm.invoke(prompt)
-        parsed_output = parser.parse(response.content)
-        print("Joke generated successfully")
+        logger.debug("Generating joke for topic: %s", topic)
+        # Any joke about a similar topic will do, so similar topics may share a cached joke
+        parsed_output = await llm_cache.cached("generate_joke", [topic], lambda: _request_joke(topic), semantic=True)
+        logger.debug("Joke generated successfully")
         
         return {
             'joke': parsed_output.joke,
@@ -43,228 +232,318 @@ def generate_joke(state):
         }
         
     except Exception as e:
-        print(f"Error generating joke: {str(e)}")
+        logger.error("Error generating joke: %s", e)
         return {
             'joke': f"Sorry, I couldn't generate a joke about {topic} right now.",
             'status': 'error'
         }
 
 
-def generate_explanation_with_suggestions(state):
+def _explanation_prompt(topic, joke):
+    """Build the messages asking for the explanation and the autosuggestions together."""
+    return [
+        ("system", _SUGGESTIONS_SYSTEM_PROMPT),
+        ("human", f"""You will be given a joke and its topic at the end.
+
+Task 1: Explain why this joke is funny in a clear and engaging way.
+
+Task 2: Select 3-4 suggestions from: {ACTION_IDS}
+
+Topic: {topic}
+Joke: {joke}"""),
+    ]
+
+
+def _explanation_output(parsed_output):
+    """Turn the parsed LLM response into the node output, using defaults if it couldn't be parsed (None)."""
+    if parsed_output is not None:
+        explanation = parsed_output.explanation
+        selected_ids = parsed_output.selected_action_ids
+        logger.debug("Explanation generated, LLM selected actions: %s", selected_ids)
+    else:
+        # Fallback: use default values if parsing failed
+        explanation = "This joke is funny!"
+        selected_ids = DEFAULT_ACTION_IDS
+    
+    suggestions = _select_suggestions(selected_ids)
+    
+    logger.debug("Generated explanation and %s autosuggestions", len(suggestions))
+    
+    return {
+        'explanation': explanation,
+        'autosuggestions': suggestions,
+        'status': 'awaiting_action'
+    }
+
+
+def _explanation_error_output():
+    """Node output used when the explanation call itself fails."""
+    return {
+        'explanation': "Sorry, I couldn't generate an explanation for this joke.",
+        'autosuggestions': [
+            {"id": "another_joke", "label": "Tell me another joke about this topic"},
+            {"id": "simpler_explanation", "label": "Explain this in simpler words"},
+            {"id": "new_topic", "label": "Tell me a joke about a different topic"}
+        ],
+        'status': 'awaiting_action'
+    }
+
+
+async def generate_explanation_with_suggestions(state):
     """
     Generate both explanation and autosuggestions in a single LLM call.
     This is more efficient and ensures contextual coherence between explanation and suggestions.
+    Skipped when handle_autosuggestion already produced them together with a new joke.
     """
+    if state.get("explanation") and state.get("autosuggestions"):
+        return {'status': 'awaiting_action'}
+    
     try:
-        llm = get_llm()
         topic = state.get("topic", "general")
         joke = state.get("joke", "")
+        prompt = _explanation_prompt(topic, joke)
         
-        # Define available actions with descriptions
-        available_actions = [
-            {
-                "id": "another_joke",
-                "label": "Tell me another joke about this topic",
-                "description": "Generate a completely new joke about the same topic"
-            },
-            {
-                "id": "simpler_explanation",
-                "label": "Explain this in simpler words",
-                "description": "Rephrase the explanation to be easier to understand"
-            },
-            {
-                "id": "new_topic",
-                "label": "Tell me a joke about a different topic",
-                "description": "Start fresh with a new topic"
-            },
-            {
-                "id": "make_funnier",
-                "label": "Make it funnier",
-                "description": "Enhance the joke to make it more humorous"
-            },
-            {
-                "id": "similar_joke",
-                "label": "Tell me a similar joke",
-                "description": "Generate a joke with similar style or theme"
-            }
-        ]
-        
-        # Set up output parser for combined output
-        parser = PydanticOutputParser(pydantic_object=ExplanationWithSuggestions)
+        logger.debug("Generating explanation and autosuggestions together...")
+        try:
+            parsed_output = await llm_cache.cached(
+                "generate_explanation_with_suggestions", [topic, joke],
+                lambda: get_structured_llm(ExplanationWithSuggestions).ainvoke(prompt)
+            )
+        except OutputParserException as parse_error:
+            logger.warning("Could not parse LLM response (%s), using fallback", parse_error)
+            parsed_output = None
         
-        # Create action list string
-        actions_str = "\n".join([f"- {action['id']}: {action['description']}" for action in available_actions])
+        return _explanation_output(parsed_output)
         
-        prompt = f"""Given this joke about "{topic}": "{joke}"
-
-Task 1: Explain why this joke is funny in a clear and engaging way.
-
-Task 2: From the following actions, select the 3-4 most relevant and useful suggestions for the user based on the joke and explanation:
-{actions_str}
+    except Exception as e:
+        logger.error("Error generating explanation and autosuggestions: %s", e)
+        # Return defaults on error
+        return _explanation_error_output()
 
-{parser.get_format_instructions()}
 
-Provide both the explanation and the selected action IDs that would be most helpful for continued user interaction."""
+async def stream_explanation_with_suggestions(state):
+    """
+    Streaming variant of generate_explanation_with_suggestions: yields the explanation text
+    chunk by chunk as the LLM produces it, then the parsed node output (a dict) last.
+    A cached response is yielded as a single chunk.
+    """
+    try:
+        topic = state.get("topic", "general")
+        joke = state.get("joke", "")
         
-        print("Generating explanation and autosuggestions together...")
-        response = llm.invoke(prompt)
+        parsed_output = llm_cache.get("generate_explanation_with_suggestions", [topic, joke])
+        if parsed_output is not None:
+            logger.debug("LLM cache hit (exact) for generate_explanation_with_suggestions")
+            yield parsed_output.explanation
+            yield _explanation_output(parsed_output)
+            return
         
-        try:
-            parsed_output = parser.parse(response.content)
-            explanation = parsed_output.explanation
-            selected_ids = parsed_output.selected_action_ids
-            print(f"Explanation generated, LLM selected actions: {selected_ids}")
-        except Exception as parse_error:
-            # Fallback: use default values if parsing fails
-            print(f"Could not parse LLM response ({parse_error}), using fallback")
-            explanation = "This joke is funny!"
-            selected_ids = ["another_joke", "simpler_explanation", "make_funnier"]
+        # Same native JSON schema mode as get_structured_llm, but streaming the raw text
+        llm = get_llm().bind(response_mime_type="application/json", response_json_schema=_COMBO_SCHEMA)
+        prompt = _explanation_prompt(topic, joke)
         
-        # Filter available actions based on LLM selection
-        suggestions = [action for action in available_actions if action["id"] in selected_ids]
+        logger.debug("Streaming explanation and autosuggestions together...")
+        chunks = []
+        streamed = ""
+        async for chunk in llm.astream(prompt):
+            if not chunk.content:
+                continue
+            chunks.append(chunk.content)
+            
+            # The response is a JSON object; pass on only the explanation text added so far
+            partial = parse_partial_json("".join(chunks))
+            explanation = partial.get("explanation") if isinstance(partial, dict) else None
+            if isinstance(explanation, str) and len(explanation) > len(streamed) and explanation.startswith(streamed):
+                yield explanation[len(streamed):]
+                streamed = explanation
         
-        # If no valid suggestions, use defaults
-        if not suggestions:
-            suggestions = available_actions[:3]
+        try:
+            parsed_output = ExplanationWithSuggestions.model_validate_json("".join(chunks))
+        except ValidationError as parse_error:
+            logger.warning("Could not parse LLM response (%s), using fallback", parse_error)
+            parsed_output = None
         
-        print(f"Generated explanation and {len(suggestions)} autosuggestions")
+        if parsed_output is not None:
+            llm_cache.set("generate_explanation_with_suggestions", [topic, joke], parsed_output)
         
-        return {
-            'explanation': explanation,
-            'autosuggestions': suggestions,
-            'status': 'awaiting_action'
-        }
+        yield _explanation_output(parsed_output)
         
     except Exception as e:
-        print(f"Error generating explanation and autosuggestions: {str(e)}")
-        # Return defaults on error
+        logger.error("Error streaming explanation and autosuggestions: %s", e)
+        yield _explanation_error_output()
+
+
+# Joke task for each joke-replacing action, filled in with the current topic and joke
+_JOKE_STEMS = {
+    "different": "Generate a different funny joke about {topic}. Make it unique and different from this one: {joke}",
+    "funnier": "Make this joke funnier and more entertaining while keeping the same topic ({topic}): {joke}",
+    "similar": "Generate a joke similar in style and humor to this one, but with different content: {joke}"
+}
+
+
+async def _generate_joke_with_suggestions(joke_task):
+    """
+    Generate a replacement joke together with its explanation and autosuggestions in a
+    single LLM call, so the explanation node doesn't need a second call for the new joke.
+    """
+    prompt = [
+        ("system", _SUGGESTIONS_SYSTEM_PROMPT),
+        ("human", f"""Task 1: Write a new joke as described in the joke task at the end.
+
+Task 2: Explain why the new joke is funny in a clear and engaging way.
+
+Task 3: Select 3-4 suggestions for the new joke from: {ACTION_IDS}
+
+Joke task: {joke_task}"""),
+    ]
+    
+    parsed_output = await llm_cache.cached(
+        "generate_joke_with_suggestions", [joke_task],
+        lambda: get_structured_llm(JokeWithExplanationAndSuggestions).ainvoke(prompt)
+    )
+    
+    return {
+        'joke': parsed_output.joke,
+        'explanation': parsed_output.explanation,
+        'autosuggestions': _select_suggestions(parsed_output.selected_action_ids)
+    }
+
+
+async def _handle_simpler_explanation(state):
+    """Simplify the explanation and pick new suggestions - uses the combined model."""
+    joke = state.get("joke", "")
+    explanation = state.get("explanation", "")
+    prompt = f"""Rephrase the explanation given at the end in very simple, easy-to-understand words suitable for a child.
+
+Also, select 3-4 relevant action IDs from: {ACTION_IDS}
+
+Explanation: {explanation}"""
+    
+    # Reuse the simplified explanation already generated for this joke, unless it is
+    # the one the user is asking to simplify again
+    parsed_output = derived_cache.get("simpler_explanation", [joke])
+    if parsed_output is not None and parsed_output.explanation != explanation:
+        logger.debug("Reusing simplified explanation cached for this joke")
+    else:
+        parsed_output = await llm_cache.cached(
+            "simpler_explanation", [explanation],
+            lambda: get_structured_llm(ExplanationWithSuggestions).ainvoke(prompt)
+        )
+        derived_cache.set("simpler_explanation", [joke], parsed_output)
+    
+    return {
+        'explanation': parsed_output.explanation,
+        'autosuggestions': _select_suggestions(parsed_output.selected_action_ids),
+        'status': 'explanation_simplified'
+    }
+
+
+async def _handle_new_topic(state):
+    """Signal that user wants a new topic (handled by API layer)."""
+    return {
+        'status': 'new_topic_requested'
+    }
+
+
+async def _handle_unknown(state):
+    """Report an action with no handler."""
+    action = state.get("selected_action", "")
+    logger.warning("Unknown action: %s", action)
+    return {
+        'status': 'error',
+        'error': f'Unknown action: {action}'
+    }
+
+
+def _joke_handler(stem_key, status):
+    """Build a handler that replaces the joke using the _JOKE_STEMS task, with its explanation and suggestions."""
+    async def handler(state):
+        joke_task = _JOKE_STEMS[stem_key].format(topic=state.get("topic", "general"), joke=state.get("joke", ""))
         return {
-            'explanation': "Sorry, I couldn't generate an explanation for this joke.",
-            'autosuggestions': [
-                {"id": "another_joke", "label": "Tell me another joke about this topic"},
-                {"id": "simpler_explanation", "label": "Explain this in simpler words"},
-                {"id": "new_topic", "label": "Tell me a joke about a different topic"}
-            ],
-            'status': 'awaiting_action'
+            **await _generate_joke_with_suggestions(joke_task),
+            'status': status
         }
+    return handler
+
+
+# Handler for each autosuggestion action id
+_HANDLERS = {
+    "another_joke": _joke_handler("different", "joke_regenerated"),
+    "simpler_explanation": _handle_simpler_explanation,
+    "make_funnier": _joke_handler("funnier", "joke_enhanced"),
+    "similar_joke": _joke_handler("similar", "similar_joke_generated"),
+    "new_topic": _handle_new_topic
+}
+
+# Actions whose results are kept in the thread's action_cache
+_CACHED_ACTIONS = frozenset(["another_joke", "simpler_explanation", "make_funnier", "similar_joke"])
+
 
+def _action_cache_key(action, state):
+    """Key of an action's result in action_cache: the action id and a hash of the joke and explanation."""
+    digest = hashlib.sha256(f"{state.get('joke', '')}\n{state.get('explanation', '')}".encode()).hexdigest()[:16]
+    return f"{action}:{digest}"
 
-def handle_autosuggestion(state):
+
+def _compact_action_result(result):
+    """Action result as stored in action_cache: suggestion ids instead of the full action dicts."""
+    entry = {key: value for key, value in result.items() if key != 'autosuggestions'}
+    entry['autosuggestion_ids'] = [action["id"] for action in result.get('autosuggestions') or []]
+    return entry
+
+
+def _expand_action_result(entry):
+    """Inverse of _compact_action_result."""
+    result = {key: value for key, value in entry.items() if key != 'autosuggestion_ids'}
+    result['autosuggestions'] = [_ACTIONS_BY_ID[action_id] for action_id in entry['autosuggestion_ids']]
+    return result
+
+
+async def _cached_action(action, state):
+    """
+    Run the action's handler through the thread's action_cache, so repeating an action on
+    the same joke and explanation (e.g. after going back to it) returns the earlier result.
+    The least recently used entries are dropped beyond ACTION_CACHE_SIZE.
+    """
+    action_cache = dict(state.get("action_cache") or {})
+    key = _action_cache_key(action, state)
+    
+    entry = action_cache.pop(key, None)
+    if entry is not None:
+        logger.debug("Reusing %s result cached for this thread", action)
+        result = _expand_action_result(entry)
+    else:
+        result = await _HANDLERS[action](state)
+        entry = _compact_action_result(result)
+    
+    action_cache[key] = entry
+    while len(action_cache) > ACTION_CACHE_SIZE:
+        del action_cache[next(iter(action_cache))]
+    
+    return {
+        **result,
+        'action_cache': action_cache
+    }
+
+
+async def handle_autosuggestion(state):
     """
     Handle the selected autosuggestion action.
-    Routes to appropriate function based on user's choice.
-    Uses Pydantic parsers for structured outputs.
+    Routes to the action's handler in _HANDLERS based on user's choice.
+    Uses the provider's native structured output for the Pydantic models.
+    Results are reused within the thread only at temperature 0, like the LLM cache.
     """
     try:
-        llm = get_llm()
         action = state.get("selected_action", "")
-        topic = state.get("topic", "general")
-        joke = state.get("joke", "")
-        explanation = state.get("explanation", "")
+        logger.debug("Handling autosuggestion action: %s", action)
         
-        print(f"Handling autosuggestion action: {action}")
+        if LLM_CACHE_ENABLED and action in _CACHED_ACTIONS:
+            return await _cached_action(action, state)
         
-        if action == "another_joke":
-            # Generate a new joke on the same topic
-            parser = PydanticOutputParser(pydantic_object=JokeOutput)
-            prompt = f"""Generate a different funny joke about {topic}. Make it unique and different from this one: {joke}
-
-{parser.get_format_instructions()}"""
-            
-            response = llm.invoke(prompt)
-            parsed_output = parser.parse(response.content)
-            
-            return {
-                'joke': parsed_output.joke,
-                'explanation': None,  # Clear explanation for new joke
-                'autosuggestions': None,  # Clear suggestions
-                'status': 'joke_regenerated'
-            }
-            
-        elif action == "simpler_explanation":
-            # Simplify the explanation - use the combined model
-            parser = PydanticOutputParser(pydantic_object=ExplanationWithSuggestions)
-            
-            # Get available actions again for regenerating suggestions
-            available_actions = [
-                {"id": "another_joke", "label": "Tell me another joke about this topic"},
-                {"id": "simpler_explanation", "label": "Explain this in simpler words"},
-                {"id": "new_topic", "label": "Tell me a joke about a different topic"},
-                {"id": "make_funnier", "label": "Make it funnier"},
-                {"id": "similar_joke", "label": "Tell me a similar joke"}
-            ]
-            
-            actions_str = "\n".join([f"- {action['id']}" for action in available_actions])
-            
-            prompt = f"""Rephrase this explanation in very simple, easy-to-understand words suitable for a child: {explanation}
-
-Also, select 3-4 relevant action IDs from: {actions_str}
-
-{parser.get_format_instructions()}"""
-            
-            response = llm.invoke(prompt)
-            parsed_output = parser.parse(response.content)
-            
-            # Filter available actions
-            suggestions = [action for action in available_actions if action["id"] in parsed_output.selected_action_ids]
-            if not suggestions:
-                suggestions = available_actions[:3]
-            
-            return {
-                'explanation': parsed_output.explanation,
-                'autosuggestions': suggestions,
-                'status': 'explanation_simplified'
-            }
-            
-        elif action == "make_funnier":
-            # Enhance the joke
-            parser = PydanticOutputParser(pydantic_object=JokeOutput)
-            prompt = f"""Make this joke funnier and more entertaining while keeping the same topic ({topic}): {joke}
-
-{parser.get_format_instructions()}"""
-            
-            response = llm.invoke(prompt)
-            parsed_output = parser.parse(response.content)
-            
-            return {
-                'joke': parsed_output.joke,
-                'explanation': None,  # Clear explanation since joke changed
-                'autosuggestions': None,
-                'status': 'joke_enhanced'
-            }
-            
-        elif action == "similar_joke":
-            # Generate similar style joke
-            parser = PydanticOutputParser(pydantic_object=JokeOutput)
-            prompt = f"""Generate a joke similar in style and humor to this one, but with different content: {joke}
-
-{parser.get_format_instructions()}"""
-            
-            response = llm.invoke(prompt)
-            parsed_output = parser.parse(response.content)
-            
-            return {
-                'joke': parsed_output.joke,
-                'explanation': None,
-                'autosuggestions': None,
-                'status': 'similar_joke_generated'
-            }
-            
-        elif action == "new_topic":
-            # Signal that user wants a new topic (handled by API layer)
-            return {
-                'status': 'new_topic_requested'
-            }
+        return await _HANDLERS.get(action, _handle_unknown)(state)
         
-        else:
-            print(f"Unknown action: {action}")
-            return {
-                'status': 'error',
-                'error': f'Unknown action: {action}'
-            }
-            
     except Exception as e:
-        print(f"Error handling autosuggestion: {str(e)}")
+        logger.error("Error handling autosuggestion: %s", e)
         return {
             'status': 'error',
             'error': str(e)
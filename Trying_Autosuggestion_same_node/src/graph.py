@@ -1,10 +1,13 @@
+import logging
 from langgraph.graph import StateGraph, START, END
 from langgraph.checkpoint.memory import InMemorySaver
 from .models import JokeState
-from .core import generate_joke, generate_explanation_with_suggestions, handle_autosuggestion
+from .core import generate_joke, generate_explanation_with_suggestions, stream_explanation_with_suggestions, handle_autosuggestion
+
+logger = logging.getLogger(__name__)
 
 def create_workflow():
-    print("Setting up stateful joke generation workflow with merged explanation and autosuggestions")
+    logger.info("Setting up stateful joke generation workflow with merged explanation and autosuggestions")
     
     # Create the state graph
     graph = StateGraph(JokeState)
@@ -48,24 +51,32 @@ def create_workflow():
         }
     )
     
-    # Create in-memory checkpointer
-    # checkpointer = InMemorySaver()
-    print("InMemorySaver checkpointer initialized")
-    
+    # No checkpointer here: the LangGraph API server (langgraph.json) supplies its own,
+    # and the FastAPI server attaches an in-memory one at startup (open_checkpointer)
     workflow = graph.compile(
-        # checkpointer=checkpointer,
         interrupt_after=['generate_joke', 'generate_explanation_with_suggestions', 'handle_autosuggestion']  # Interrupt after all nodes
     )
-    print("Workflow setup completed with merged explanation+suggestions node")
+    logger.info("Workflow setup completed with merged explanation+suggestions node")
     
     return workflow
 # Create global workflow instance
 workflow = create_workflow()
 
-def start_joke_generation(topic: str, thread_id: str):
+
+async def open_checkpointer():
+    """Attach an in-memory checkpointer to the workflow so thread state persists between requests."""
+    workflow.checkpointer = InMemorySaver()
+    logger.info("InMemorySaver checkpointer initialized")
+
+
+async def close_checkpointer():
+    """Detach the checkpointer, dropping all thread state."""
+    workflow.checkpointer = None
+
+async def start_joke_generation(topic: str, thread_id: str):
     try:
         config = {"configurable": {"thread_id": thread_id}}
-        print(f"Starting joke generation for topic: {topic}, thread: {thread_id}")
+        logger.info("Starting joke generation for topic: %s, thread: %s", topic, thread_id)
         
         # Initial state
         initial_state = {
@@ -77,8 +88,8 @@ def start_joke_generation(topic: str, thread_id: str):
             'status': 'started'
         }
         
-        result = workflow.invoke(initial_state, config=config)
-        print(f"Joke generation completed for thread: {thread_id}")
+        result = await workflow.ainvoke(initial_state, config=config)
+        logger.info("Joke generation completed for thread: %s", thread_id)
         
         return {
             'topic': result.get('topic'),
@@ -87,17 +98,17 @@ def start_joke_generation(topic: str, thread_id: str):
             'thread_id': thread_id
         }
     except Exception as e:
-        print(f"Error in start_joke_generation: {str(e)}")
+        logger.error("Error in start_joke_generation: %s", e)
         raise
 
 
-def continue_with_explanation(thread_id: str):
+async def continue_with_explanation(thread_id: str):
     try:
         config = {"configurable": {"thread_id": thread_id}}
-        print(f"Continuing workflow for thread: {thread_id}")
+        logger.info("Continuing workflow for thread: %s", thread_id)
         
         # Get current state to verify it exists
-        current_state = workflow.get_state(config)
+        current_state = await workflow.aget_state(config)
         
         if not current_state or not current_state.values:
             raise ValueError(f"No active workflow found for thread_id: {thread_id}")
@@ -107,8 +118,8 @@ def continue_with_explanation(thread_id: str):
             raise ValueError(f"No joke found for thread_id: {thread_id}. Start workflow first.")
         
         # Continue from where we left off (None means continue with no new input)
-        result = workflow.invoke(None, config=config)
-        print(f"Explanation and autosuggestions generated for thread: {thread_id}")
+        result = await workflow.ainvoke(None, config=config)
+        logger.info("Explanation and autosuggestions generated for thread: %s", thread_id)
         
         return {
             'topic': result.get('topic'),
@@ -119,11 +130,57 @@ def continue_with_explanation(thread_id: str):
             'thread_id': thread_id
         }
     except Exception as e:
-        print(f"Error in continue_with_explanation: {str(e)}")
+        logger.error("Error in continue_with_explanation: %s", e)
         raise
 
 
-def handle_user_action(thread_id: str, action: str):
+async def stream_continue_with_explanation(thread_id: str):
+    """
+    Streaming variant of continue_with_explanation: yields the explanation response text
+    as it is generated, then the same result dict as continue_with_explanation last.
+    The streamed output is saved as generate_explanation_with_suggestions' output, so the
+    thread ends up paused exactly where /continue would leave it.
+    """
+    config = {"configurable": {"thread_id": thread_id}}
+    logger.info("Streaming continuation for thread: %s", thread_id)
+    
+    current_state = await workflow.aget_state(config)
+    
+    if not current_state or not current_state.values:
+        raise ValueError(f"No active workflow found for thread_id: {thread_id}")
+    
+    if not current_state.values.get('joke'):
+        raise ValueError(f"No joke found for thread_id: {thread_id}. Start workflow first.")
+    
+    values = current_state.values
+    
+    # Nothing to stream unless the thread is about to generate a new explanation
+    if (current_state.next != ('generate_explanation_with_suggestions',)
+            or (values.get('explanation') and values.get('autosuggestions'))):
+        yield await continue_with_explanation(thread_id)
+        return
+    
+    output = None
+    async for item in stream_explanation_with_suggestions(values):
+        if isinstance(item, dict):
+            output = item
+        else:
+            yield item
+    
+    await workflow.aupdate_state(config, output, as_node='generate_explanation_with_suggestions')
+    logger.info("Streamed explanation and autosuggestions saved for thread: %s", thread_id)
+    
+    yield {
+        'topic': values.get('topic'),
+        'joke': values.get('joke'),
+        'explanation': output.get('explanation'),
+        'autosuggestions': output.get('autosuggestions'),
+        'status': output.get('status', 'awaiting_action'),
+        'thread_id': thread_id
+    }
+
+
+async def handle_user_action(thread_id: str, action: str):
     """
     Handle user's selected autosuggestion action.
     
@@ -133,23 +190,33 @@ def handle_user_action(thread_id: str, action: str):
     """
     try:
         config = {"configurable": {"thread_id": thread_id}}
-        print(f"Handling user action '{action}' for thread: {thread_id}")
+        logger.info("Handling user action '%s' for thread: %s", action, thread_id)
         
         # Get current state
-        current_state = workflow.get_state(config)
+        current_state = await workflow.aget_state(config)
         
         if not current_state or not current_state.values:
             raise ValueError(f"No active workflow found for thread_id: {thread_id}")
         
-        # Update state with selected action
-        updated_state = {
-            **current_state.values,
-            'selected_action': action
-        }
+        values = current_state.values
+        
+        # Write only the selected action, then resume the interrupted workflow
+        if current_state.next == ('handle_autosuggestion',):
+            await workflow.aupdate_state(config, {'selected_action': action})
+        elif not current_state.next or (
+                current_state.next == ('generate_explanation_with_suggestions',)
+                and values.get('explanation') and values.get('autosuggestions')):
+            # The previous action ended the workflow (e.g. simpler_explanation), or produced
+            # the new joke's explanation already: re-enter it just before handle_autosuggestion
+            await workflow.aupdate_state(config, {'selected_action': action}, as_node='generate_explanation_with_suggestions')
+        else:
+            raise ValueError(
+                f"Thread {thread_id} is not waiting for an action (next step: {current_state.next[0]}). "
+                "Call /continue first."
+            )
         
-        # Continue workflow with the action
-        result = workflow.invoke(updated_state, config=config)
-        print(f"Action '{action}' completed for thread: {thread_id}")
+        result = await workflow.ainvoke(None, config=config)
+        logger.info("Action '%s' completed for thread: %s", action, thread_id)
         
         return {
             'topic': result.get('topic'),
@@ -161,14 +228,14 @@ def handle_user_action(thread_id: str, action: str):
             'action_performed': action
         }
     except Exception as e:
-        print(f"Error in handle_user_action: {str(e)}")
+        logger.error("Error in handle_user_action: %s", e)
         raise
 
 
-def get_thread_status(thread_id: str):
+async def get_thread_status(thread_id: str):
     try:
         config = {"configurable": {"thread_id": thread_id}}
-        state = workflow.get_state(config)
+        state = await workflow.aget_state(config)
         
         if not state or not state.values:
             return {
@@ -188,5 +255,5 @@ def get_thread_status(thread_id: str):
             'next_node': state.next[0] if state.next else None
         }
     except Exception as e:
-        print(f"Error in get_thread_status: {str(e)}")
+        logger.error("Error in get_thread_status: %s", e)
         raise
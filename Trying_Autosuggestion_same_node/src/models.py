@@ -2,7 +2,7 @@
 Data models and state definitions for the joke generation agent.
 """
 
-from typing import TypedDict, Optional, List
+from typing import TypedDict, Optional, List, Dict
 
 
 class JokeState(TypedDict):
@@ -16,6 +16,8 @@ class JokeState(TypedDict):
         autosuggestions (List[dict]): List of suggested actions user can take
         selected_action (str): The action selected by user from autosuggestions
         status (str): Current status of the workflow
+        action_cache (Dict[str, dict]): Recent action results in this thread (with suggestion ids
+            instead of full suggestions), least recently used first
     """
     topic: str
     joke: Optional[str]
@@ -23,3 +25,4 @@ class JokeState(TypedDict):
     autosuggestions: Optional[List[dict]]
     selected_action: Optional[str]
     status: str  # "started", "joke_generated", "explanation_generated", "awaiting_action", "completed"
+    action_cache: Optional[Dict[str, dict]]
@@ -4,12 +4,15 @@ Run the server first with: python main.py
 Then run this script: python test_api.py
 """
 
-import requests
-import time
+import asyncio
+import httpx
 import json
 
 BASE_URL = "http://localhost:8000"
 
+# One keep-alive connection pool shared by every test (and by the concurrent requests in them)
+CLIENT = httpx.AsyncClient(base_url=BASE_URL, timeout=60.0, limits=httpx.Limits(max_connections=10))
+
 def print_response(title, response):
     """Pretty print API response."""
     print(f"\n{'='*60}")
@@ -22,99 +25,109 @@ def print_response(title, response):
         print(response.text)
     print(f"{'='*60}\n")
 
-def test_health():
+async def test_health():
     """Test health endpoint."""
     print("🔍 Testing /health endpoint...")
-    response = requests.get(f"{BASE_URL}/health")
+    response = await CLIENT.get("/health")
     print_response("Health Check", response)
     return response.status_code == 200
 
-def test_start():
+async def test_start():
     """Test start endpoint."""
     print("🚀 Testing /start endpoint...")
     payload = {
         "topic": "artificial intelligence",
         "thread_id": "test_thread_1"
     }
-    response = requests.post(f"{BASE_URL}/start", json=payload)
+    response = await CLIENT.post("/start", json=payload)
     print_response("Start Joke Generation", response)
     return response.status_code == 200
 
-def test_status():
+async def test_status():
     """Test status endpoint."""
     print("📊 Testing /status endpoint...")
     payload = {
         "thread_id": "test_thread_1"
     }
-    response = requests.post(f"{BASE_URL}/status", json=payload)
+    response = await CLIENT.post("/status", json=payload)
     print_response("Check Thread Status", response)
     return response.status_code == 200
 
-def test_continue():
+async def test_continue():
     """Test continue endpoint."""
     print("➡️ Testing /continue endpoint...")
     payload = {
         "thread_id": "test_thread_1"
     }
-    response = requests.post(f"{BASE_URL}/continue", json=payload)
+    response = await CLIENT.post("/continue", json=payload)
     print_response("Continue with Explanation", response)
     return response.status_code == 200
 
-def test_restart():
+async def test_restart():
     """Test restarting with same thread_id."""
     print("🔄 Testing restart with same thread_id...")
     payload = {
         "topic": "machine learning",
         "thread_id": "test_thread_1"
     }
-    response = requests.post(f"{BASE_URL}/start", json=payload)
+    response = await CLIENT.post("/start", json=payload)
     print_response("Restart with New Topic", response)
     return response.status_code == 200
 
-def test_invalid_thread():
+async def test_invalid_thread():
     """Test continue with invalid thread_id."""
     print("❌ Testing /continue with invalid thread_id...")
     payload = {
         "thread_id": "non_existent_thread"
     }
-    response = requests.post(f"{BASE_URL}/continue", json=payload)
+    response = await CLIENT.post("/continue", json=payload)
     print_response("Continue with Invalid Thread (Should Fail)", response)
     return response.status_code == 404
 
-def test_multiple_threads():
+async def test_multiple_threads():
     """Test multiple simultaneous threads."""
     print("🔀 Testing multiple threads...")
     
-    # Thread 2
-    print("\n  Creating thread 2...")
+    # Threads 2 and 3, created concurrently
+    print("\n  Creating threads 2 and 3...")
     payload1 = {
         "topic": "cats",
         "thread_id": "test_thread_2"
     }
-    response1 = requests.post(f"{BASE_URL}/start", json=payload1)
-    print(f"  Thread 2 joke: {response1.json().get('joke', 'N/A')[:50]}...")
-    
-    # Thread 3
-    print("\n  Creating thread 3...")
     payload2 = {
         "topic": "dogs",
         "thread_id": "test_thread_3"
     }
-    response2 = requests.post(f"{BASE_URL}/start", json=payload2)
+    response1, response2 = await asyncio.gather(
+        CLIENT.post("/start", json=payload1),
+        CLIENT.post("/start", json=payload2)
+    )
+    print(f"  Thread 2 joke: {response1.json().get('joke', 'N/A')[:50]}...")
     print(f"  Thread 3 joke: {response2.json().get('joke', 'N/A')[:50]}...")
     
     # Check both threads are independent
-    print("\n  Checking thread 2 status...")
-    status2 = requests.post(f"{BASE_URL}/status", json={"thread_id": "test_thread_2"})
+    print("\n  Checking thread 2 and 3 status...")
+    status2, status3 = await asyncio.gather(
+        CLIENT.post("/status", json={"thread_id": "test_thread_2"}),
+        CLIENT.post("/status", json={"thread_id": "test_thread_3"})
+    )
     print(f"  Thread 2 topic: {status2.json().get('topic')}")
-    
-    print("\n  Checking thread 3 status...")
-    status3 = requests.post(f"{BASE_URL}/status", json={"thread_id": "test_thread_3"})
     print(f"  Thread 3 topic: {status3.json().get('topic')}")
     
     return response1.status_code == 200 and response2.status_code == 200
 
-def run_all_tests():
+async def test_action_after_simpler_explanation():
+    """Test an action after simpler_explanation, which ends the workflow."""
+    print("🎯 Testing /action after simpler_explanation...")
+    thread = {"thread_id": "test_thread_4"}
+    await CLIENT.post("/start", json={"topic": "penguins", **thread})
+    await CLIENT.post("/continue", json=thread)
+    await CLIENT.post("/action", json={**thread, "action": "simpler_explanation"})
+    response = await CLIENT.post("/action", json={**thread, "action": "make_funnier"})
+    print_response("Make Funnier After Simpler Explanation", response)
+    return response.status_code == 200 and response.json().get("status") == "joke_enhanced"
+
+async def run_all_tests():
     """Run all API tests."""
     print("\n" + "="*60)
     print("🧪 STATEFUL JOKE GENERATION API - TEST SUITE")
@@ -129,22 +142,22 @@ def run_all_tests():
         ("Restart Thread", test_restart),
         ("Invalid Thread", test_invalid_thread),
         ("Multiple Threads", test_multiple_threads),
+        ("Action After Simpler Explanation", test_action_after_simpler_explanation),
     ]
     
     results = []
     
-    for test_name, test_func in tests:
-        try:
-            success = test_func()
-            results.append((test_name, "✅ PASSED" if success else "❌ FAILED"))
-        except requests.exceptions.ConnectionError:
-            print(f"\n❌ ERROR: Cannot connect to server at {BASE_URL}")
-            print("Make sure the server is running: python main.py")
-            return
-        except Exception as e:
-            results.append((test_name, f"❌ ERROR: {str(e)}"))
-        
-        time.sleep(1)  # Small delay between tests
+    async with CLIENT:
+        for test_name, test_func in tests:
+            try:
+                success = await test_func()
+                results.append((test_name, "✅ PASSED" if success else "❌ FAILED"))
+            except httpx.ConnectError:
+                print(f"\n❌ ERROR: Cannot connect to server at {BASE_URL}")
+                print("Make sure the server is running: python main.py")
+                return
+            except Exception as e:
+                results.append((test_name, f"❌ ERROR: {str(e)}"))
     
     # Print summary
     print("\n" + "="*60)
@@ -165,7 +178,7 @@ def run_all_tests():
 
 if __name__ == "__main__":
     try:
-        run_all_tests()
+        asyncio.run(run_all_tests())
     except KeyboardInterrupt:
         print("\n\n⏸️  Tests interrupted by user")
     except Exception as e: